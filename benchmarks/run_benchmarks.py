@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+from urllib.request import urlopen
+
+_logger = logging.getLogger(__name__)
+
+benchmark_path = os.path.dirname(os.path.realpath(__file__))
+repo_path = os.path.dirname(benchmark_path)
+stand_ins = os.path.join(benchmark_path, 'stand_ins.py')
+
+# runs that are compared between results files
+result_key = ['benchmark', 'entities', 'latency', 'workers']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def stand_in_get(port, path):
+    with urlopen(f'http://127.0.0.1:{port}{path}') as response:
+        return json.load(response)
+
+def start_stand_in(name, latency, jitter, *args):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, stand_ins, name, '--port', str(port), '--latency', str(latency), '--jitter', str(jitter), *args])
+    for _ in range(600):
+        try:
+            stand_in_get(port, '/_stats')
+            return process, port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'The {name} stand-in did not start')
+
+def stop_stand_in(process):
+    process.terminate()
+    process.wait()
+
+def request_count(port):
+    stats = stand_in_get(port, '/_stats')
+    stand_in_get(port, '/_reset')
+    return sum(stats.values())
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def timed_run(command, cwd, env, log_file):
+    start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        result = subprocess.run(command, cwd=cwd, env=dict(os.environ, **env), stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(f'{" ".join(command)} exited with {result.returncode}, see {log_file}')
+    return elapsed
+
+def stage_totals(metrics_file):
+    if not os.path.exists(metrics_file):
+        return {}
+    with open(metrics_file) as f:
+        return {name: round(timing['total'], 3) for name, timing in json.load(f)['stages'].items()}
+
+
+def corpus_file(work_path, entities):
+    file_name = os.path.join(work_path, f'corpus-{entities}.json.gz')
+    if not os.path.exists(file_name):
+        subprocess.run([sys.executable, stand_ins, 'corpus', '--entities', str(entities), '--output', file_name], check=True)
+    return file_name
+
+def write_site_file(file_name, port):
+    raw = f'http://127.0.0.1:{port}/raw'
+    site = {
+        'title': 'Benchmark', 'about': 'Benchmark site', 'copyright': 'Benchmark',
+        'sparql': 'SELECT ?item ?itemLabel WHERE {}',
+        'bioUrlPrefix': f'{raw}/bio/', 'publicationsUrlPrefix': f'{raw}/pub/', 'propertyOverrideUrlPrefix': f'{raw}/override/',
+        'images': f'{raw}/images/', 'properties': f'{raw}/properties.csv'
+    }
+    with open(file_name, 'w') as f:
+        json.dump(site, f)
+
+def run_wikiloader(run_path, port, workers, extra_args):
+    # a cold run with an empty cache and a warm run that revalidates it
+    site_file = os.path.join(run_path, 'site.json')
+    write_site_file(site_file, port)
+    os.makedirs(os.path.join(run_path, 'data'))
+    base = f'http://127.0.0.1:{port}'
+    env = {'HTTP_HOST_OVERRIDES': f'www.wikidata.org={base},query.wikidata.org={base},commons.wikimedia.org={base}/commons'}
+    results = []
+    for benchmark in ['wikiloader-cold', 'wikiloader-warm']:
+        metrics_file = os.path.join(run_path, f'{benchmark}.metrics.json')
+        command = [sys.executable, os.path.join(repo_path, 'wikiloader.py'), '--site-file', site_file, '--data-path', os.path.join(run_path, 'data'),
+                   '--cache-path', os.path.join(run_path, 'cache'), '--workers', str(workers), '--metrics', metrics_file, *extra_args]
+        seconds = timed_run(command, run_path, env, os.path.join(run_path, f'{benchmark}.log'))
+        results.append({'benchmark': benchmark, 'seconds': seconds, 'requests': request_count(port), 'stages': stage_totals(metrics_file)})
+    return results
+
+def run_omeka(run_path, port, entities, workers):
+    # a first upload to an empty Omeka and a second one that updates every item
+    env = {'OMEKA_API': f'http://127.0.0.1:{port}', 'OMEKA_KEY': 'benchmark', 'OMEKA_CRED': 'benchmark', 'OMEKA_UPLOAD_WORKERS': str(workers)}
+    results = []
+    for benchmark in ['omeka-first', 'omeka-second']:
+        metrics_file = os.path.join(run_path, f'{benchmark}.metrics.json')
+        command = [sys.executable, os.path.realpath(__file__), 'upload', '--data-path', os.path.join(run_path, 'data'), '--entities', str(entities), '--metrics', metrics_file, '--images-path', os.path.join(run_path, 'images')]
+        seconds = timed_run(command, run_path, env, os.path.join(run_path, f'{benchmark}.log'))
+        results.append({'benchmark': benchmark, 'seconds': seconds, 'requests': request_count(port), 'stages': stage_totals(metrics_file)})
+    return results
+
+def upload(args):
+    # runs in its own process so every run starts with fresh module state
+    sys.path.insert(0, repo_path)
+    import omeka_upload
+    import run_metrics
+    omeka_upload.data_path = args.data_path
+    omeka_upload.MAX_OBJECTS = args.entities
+    omeka_upload.OMEKA_ITEM_SET = 1
+    omeka_upload.OMEKA_SITE = 1
+    # the copies upload_images keeps of the uploaded images stay in the run directory instead of the repository
+    omeka_upload.images_path = args.images_path
+    os.makedirs(args.images_path, exist_ok=True)
+    with run_metrics.stage('upload'):
+        omeka_upload.load_data()
+    run_metrics.write_summary(args.metrics)
+
+
+def load_results(file_name):
+    with open(file_name) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def print_results(results, baseline = None):
+    # the latest baseline result of each run is the reference
+    reference = {}
+    for result in baseline or []:
+        reference[tuple(result[k] for k in result_key)] = result
+    print(f'{"benchmark":<16} {"entities":>8} {"latency":>8} {"workers":>7} {"seconds":>9} {"requests":>9} {"baseline":>9} {"change":>8}')
+    for result in results:
+        before = reference.get(tuple(result[k] for k in result_key))
+        compared = f'{before["seconds"]:>9.2f} {result["seconds"] / before["seconds"] - 1:>+8.1%}' if before else ''
+        print(f'{result["benchmark"]:<16} {result["entities"]:>8} {result["latency"]:>8} {result["workers"]:>7} {result["seconds"]:>9.2f} {result["requests"]:>9} {compared}')
+
+def run(args):
+    work_path = os.path.realpath(args.work_path)
+    os.makedirs(work_path, exist_ok=True)
+    context = {'commit': git_commit(), 'time': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'python': platform.python_version()}
+    results = []
+    for entities in args.entities:
+        corpus = args.corpus or corpus_file(work_path, entities)
+        for latency in args.latency:
+            _logger.info(f'Benchmarking {entities} entities with {latency}s latency')
+            run_path = os.path.join(work_path, f'run-{entities}-{latency}')
+            shutil.rmtree(run_path, ignore_errors=True)
+            os.makedirs(run_path)
+            runs = []
+            process, port = start_stand_in('wikidata', latency, args.jitter, '--corpus', corpus)
+            try:
+                runs.extend(run_wikiloader(run_path, port, args.workers, args.wikiloader_args))
+            finally:
+                stop_stand_in(process)
+            if not args.skip_omeka:
+                process, port = start_stand_in('omeka', latency, args.jitter)
+                try:
+                    runs.extend(run_omeka(run_path, port, entities, args.workers))
+                finally:
+                    stop_stand_in(process)
+            for result in runs:
+                result.update({'entities': entities, 'latency': latency, 'workers': args.workers}, **context)
+                _logger.info(f'{result["benchmark"]}: {result["seconds"]:.2f}s, {result["requests"]} requests')
+            results.extend(runs)
+            with open(args.output, 'a') as f:
+                for result in runs:
+                    f.write(json.dumps(result) + '\n')
+    print_results(results, load_results(args.baseline) if args.baseline else None)
+
+
+def main():
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    parser = argparse.ArgumentParser(description='Time wikiloader and omeka_upload end to end against local stand-ins')
+    subparsers = parser.add_subparsers(dest='command')
+    parser.add_argument('--entities', type=lambda v: [int(n) for n in v.split(',')], default=[100, 1000, 10000], help='Comma separated corpus sizes (default 100,1000,10000)')
+    parser.add_argument('--corpus', help='Serve this corpus (eg one recorded with stand_ins.py corpus --cache-path) instead of a generated one')
+    parser.add_argument('--latency', type=lambda v: [float(n) for n in v.split(',')], default=[0.0], help='Comma separated seconds added to every stand-in response (default 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many random seconds added to every response')
+    parser.add_argument('--workers', type=int, default=1, help='wikiloader --workers and OMEKA_UPLOAD_WORKERS (default 1)')
+    parser.add_argument('--skip-omeka', action='store_true', help='Only benchmark wikiloader')
+    parser.add_argument('--wikiloader-args', nargs=argparse.REMAINDER, default=[], help='Further wikiloader arguments, eg --wikiloader-args --compact --precompress')
+    parser.add_argument('--work-path', default=os.path.join(benchmark_path, 'work'), help='Directory for corpora, caches and outputs (default benchmarks/work)')
+    parser.add_argument('--output', default=os.path.join(benchmark_path, 'results.jsonl'), help='Results are appended to this file (default benchmarks/results.jsonl)')
+    parser.add_argument('--baseline', help='Results file of an earlier run to compare with')
+    upload_parser = subparsers.add_parser('upload', help=argparse.SUPPRESS)
+    upload_parser.add_argument('--data-path', required=True)
+    upload_parser.add_argument('--entities', type=int, required=True)
+    upload_parser.add_argument('--metrics', required=True)
+    upload_parser.add_argument('--images-path', required=True)
+    args = parser.parse_args()
+    if args.command == 'upload':
+        upload(args)
+    else:
+        run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+import os
+import re
+import io
+import sys
+import json
+import gzip
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import entity_cache
+
+_logger = logging.getLogger(__name__)
+
+# local stand-ins for Wikidata / Commons / raw GitHub files and for the Omeka S api, used by run_benchmarks.py
+
+modified = '2024-01-01T00:00:00Z'
+last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+image_variants = 8
+
+# the people only use properties that omeka_upload has in property_map.json
+properties = {
+    'P19': 'place of birth', 'P69': 'educated at', 'P569': 'date of birth', 'P570': 'date of death', 'P21': 'sex or gender',
+    'P3373': 'sibling', 'P551': 'residence', 'P108': 'employer', 'P625': 'coordinate location', 'P31': 'instance of',
+    'P131': 'located in the administrative territorial entity', 'P17': 'country', 'P3896': 'geoshape'
+}
+# properties that are looked up but not shown on the site
+hidden_properties = ['P625', 'P31', 'P131', 'P17', 'P3896']
+
+
+def snak(property_id, datatype, value):
+    return {'snaktype': 'value', 'property': property_id, 'datatype': datatype, 'datavalue': {'value': value}}
+
+def statement(property_id, datatype, value):
+    return {'mainsnak': snak(property_id, datatype, value), 'type': 'statement'}
+
+def item_statement(property_id, id):
+    return statement(property_id, 'wikibase-item', {'id': id})
+
+def corpus_entity(id, label, claims):
+    return {'id': id, 'type': 'property' if id.startswith('P') else 'item', 'labels': {'en': {'language': 'en', 'value': label}}, 'claims': claims, 'modified': modified, 'lastrevid': 1}
+
+def build_corpus(size):
+    # a deterministic corpus of size people with the places, universities and classes they refer to
+    entities = {id: corpus_entity(id, label, {}) for id, label in properties.items()}
+    for id, label in [('Q515', 'city'), ('Q3918', 'university'), ('Q35657', 'state of the United States'), ('Q6581097', 'male'), ('Q11573', 'metre'), ('Q30', 'United States of America')]:
+        entities[id] = corpus_entity(id, label, {})
+    states = [f'Q3{s:05d}' for s in range(50)]
+    cities = [f'Q2{c:05d}' for c in range(max(10, size // 10))]
+    universities = [f'Q4{u:05d}' for u in range(max(4, size // 25))]
+    people = [f'Q1{p:06d}' for p in range(size)]
+    for s, id in enumerate(states):
+        entities[id] = corpus_entity(id, f'State {s}', {'P31': [item_statement('P31', 'Q35657')], 'P17': [item_statement('P17', 'Q30')]})
+    for c, id in enumerate(cities):
+        entities[id] = corpus_entity(id, f'City {c}', {
+            'P31': [item_statement('P31', 'Q515')], 'P131': [item_statement('P131', states[c % len(states)])], 'P17': [item_statement('P17', 'Q30')],
+            'P625': [statement('P625', 'globe-coordinate', {'latitude': 30 + c % 20, 'longitude': -70 - c % 50})],
+            'P3896': [statement('P3896', 'geo-shape', f'Data:City{c % 50}.map')]})
+    for u, id in enumerate(universities):
+        entities[id] = corpus_entity(id, f'University {u}', {
+            'P31': [item_statement('P31', 'Q3918')], 'P131': [item_statement('P131', cities[u % len(cities)])],
+            'P625': [statement('P625', 'globe-coordinate', {'latitude': 31 + u % 20, 'longitude': -72 - u % 50})]})
+    for p, id in enumerate(people):
+        claims = {
+            'P19': [item_statement('P19', cities[p % len(cities)])],
+            'P69': [item_statement('P69', universities[p % len(universities)]), item_statement('P69', universities[(p + 1) % len(universities)])],
+            'P569': [statement('P569', 'time', {'time': f'+18{p % 100:02d}-01-01T00:00:00Z'})],
+            'P21': [item_statement('P21', 'Q6581097')],
+            'P551': [item_statement('P551', cities[(p * 7) % len(cities)])],
+            'P108': [item_statement('P108', universities[(p * 3) % len(universities)])]}
+        if p % 2:
+            claims['P570'] = [statement('P570', 'time', {'time': f'+19{p % 100:02d}-01-01T00:00:00Z'})]
+        if p % 10:
+            claims['P3373'] = [item_statement('P3373', people[p - 1])]
+        entities[id] = corpus_entity(id, f'Person {p} Smith', claims)
+    return {'people': people, 'entities': entities}
+
+def record_corpus(cache_backend, cache_path, people):
+    # a corpus of the entities a wikiloader run left in its cache, markdown and images stay synthetic
+    cache = entity_cache.open_entity_cache(cache_backend, cache_path)
+    entities = {}
+    for id in cache.ids():
+        entity = cache.get(id)
+        if entity:
+            entities[id] = entity
+    return {'people': [id for id in people if id in entities], 'entities': entities}
+
+def save_corpus(corpus, file_name):
+    with gzip.open(file_name, 'wt') as f:
+        json.dump(corpus, f)
+
+def load_corpus(file_name):
+    with gzip.open(file_name, 'rt') as f:
+        return json.load(f)
+
+
+def person_index(id):
+    return int(id[1:]) if id[1:].isdigit() else 0
+
+def synthetic_image(variant):
+    image = Image.new('RGB', (640, 480), (variant * 31 % 255, 100, 150))
+    content = io.BytesIO()
+    image.save(content, 'JPEG')
+    return content.getvalue()
+
+def synthetic_file(corpus, kind, id):
+    # every other person has an image, two of three a biography, one of four publications and one of five overrides
+    if id not in corpus['entities']:
+        return None
+    i = person_index(id)
+    if kind == 'images':
+        return synthetic_image(i % image_variants) if i % 2 == 0 else None
+    if kind == 'bio':
+        label = corpus['entities'][id]['labels'].get('en', {}).get('value', id)
+        return f'# {label}\n## Scholar number {i}\nBorn in **City {i % 10}**. Studied things.\n\nImage citation: Somebody\n'.encode() if i % 3 != 2 else None
+    if kind == 'pub':
+        return f'- Paper {i}, *Journal* (19{i % 100:02d})\n'.encode() if i % 4 == 0 else None
+    if kind == 'override':
+        return json.dumps({'date of death': {'label': 'date of death', 'values': [{'value-type': 'string', 'text': 'unknown'}]}}).encode() if i % 5 == 0 else None
+
+def geo_shape_page(title):
+    return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': {'title': title}, 'geometry': {'type': 'Point', 'coordinates': [-72, 41]}}]}
+
+
+class stand_in_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # without it small keep-alive responses wait ~40ms for delayed ACKs
+    disable_nagle_algorithm = True
+    latency = 0.0
+    jitter = 0.0
+    stats = None
+    stats_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body = b'', content_type = 'application/json', headers = None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def request_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def handle_request(self, handler):
+        url = urlparse(self.path)
+        if url.path == '/_stats':
+            with self.stats_lock:
+                return self.send(200, self.stats)
+        if url.path == '/_reset':
+            with self.stats_lock:
+                self.stats.clear()
+            return self.send(200, {})
+        key = f'{self.command} {re.sub(r"/(Q|P)?[0-9]+", "/N", url.path)}'
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        handler(url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+
+
+class wikidata_handler(stand_in_handler):
+    corpus = None
+
+    def do_GET(self):
+        self.handle_request(self.get)
+
+    def get(self, path, query):
+        entities = self.corpus['entities']
+        match = re.match(r'/wiki/Special:EntityData/(\w+)\.json$', path)
+        if match:
+            id = match.group(1)
+            if id not in entities:
+                return self.send(404, {})
+            since = self.headers.get('If-Modified-Since')
+            if since and datetime.fromisoformat(entities[id]['modified'].replace('Z', '+00:00')) <= parsedate_to_datetime(since):
+                return self.send(304)
+            return self.send(200, {'entities': {id: entities[id]}})
+        if path == '/w/api.php' and query.get('action') == 'wbgetentities':
+            result = {}
+            for id in query.get('ids', '').split('|')[:50]:
+                if id not in entities:
+                    result[id] = {'id': id, 'missing': ''}
+                elif query.get('props') == 'info':
+                    result[id] = {k: v for k, v in entities[id].items() if k in ('id', 'type', 'modified', 'lastrevid')}
+                else:
+                    result[id] = entities[id]
+            return self.send(200, {'entities': result, 'success': 1})
+        if path == '/commons/w/api.php':
+            titles = query.get('titles', '').split('|')
+            if query.get('prop') == 'info':
+                return self.send(200, {'query': {'pages': {str(i + 1): {'title': title, 'lastrevid': 1} for i, title in enumerate(titles)}}})
+            content = json.dumps({'license': 'CC0-1.0', 'data': geo_shape_page(titles[0])})
+            return self.send(200, {'query': {'pages': {'1': {'title': titles[0], 'revisions': [{'revid': 1, 'slots': {'main': {'*': content}}}]}}}})
+        if path == '/sparql':
+            bindings = [{'item': {'value': f'http://www.wikidata.org/entity/{id}'}, 'itemLabel': {'value': entities[id]['labels'].get('en', {}).get('value', id)}} for id in self.corpus['people']]
+            return self.send(200, {'results': {'bindings': bindings}})
+        if path == '/raw/properties.csv':
+            shown = [id for id in entities if id.startswith('P') and id not in hidden_properties]
+            return self.send(200, '\n'.join(f'{id}\t{entities[id]["labels"]["en"]["value"]}' for id in shown).encode(), 'text/plain')
+        match = re.match(r'/raw/(bio|pub|override|images)/(Q\d+)\.(md|json|jpg)$', path)
+        if match:
+            content = synthetic_file(self.corpus, match.group(1), match.group(2))
+            if content is None:
+                return self.send(404)
+            etag = f'"{hashlib.md5(content).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                return self.send(304, headers={'ETag': etag})
+            return self.send(200, content, 'application/octet-stream', {'ETag': etag, 'Last-Modified': last_modified})
+        self.send(404)
+
+
+class omeka_handler(stand_in_handler):
+    # the parts of the Omeka S api used by omeka_upload, kept in memory
+    state = None
+    state_lock = threading.Lock()
+    resource_class_terms = ['schema:Person', 'schema:Place', 'schema:Organization', 'schema:EducationalOrganization']
+
+    def do_GET(self):
+        self.handle_request(self.get)
+
+    def do_POST(self):
+        self.handle_request(self.post)
+
+    def do_PUT(self):
+        self.handle_request(self.put)
+
+    def do_DELETE(self):
+        self.handle_request(self.delete)
+
+    def term_id(self, term):
+        return int(hashlib.md5(term.encode()).hexdigest()[:6], 16) % 1000 + 1
+
+    def new_id(self):
+        self.state['next_id'] += 1
+        return self.state['next_id']
+
+    def store_item(self, item, id = None):
+        item = dict(item)
+        item['o:id'] = id or self.new_id()
+        item['@type'] = ['o:Item'] + ([item['@type']] if isinstance(item.get('@type'), str) else [])
+        resource_class = (item.get('o:resource_class') or {}).get('o:id')
+        for term in self.resource_class_terms:
+            if self.term_id(term) == resource_class and term not in item['@type']:
+                item['@type'].append(term)
+        if isinstance(item.get('o:title'), list):
+            item['o:title'] = item['o:title'][0].get('@value')
+        for marker in item.get('o-module-mapping:marker', []):
+            marker.setdefault('o:id', self.new_id())
+            self.state['markers'][marker['o:id']] = marker
+        if item.get('o-module-mapping:mapping') is not None:
+            item['o-module-mapping:mapping'].setdefault('o:id', self.new_id())
+        item['o:modified'] = {'@value': datetime.now(timezone.utc).isoformat(), 'serial': self.new_id()}
+        existing = self.state['items'].get(item['o:id'])
+        item['o:media'] = existing['o:media'] if existing else []
+        self.state['items'][item['o:id']] = item
+        return item
+
+    def in_item_set(self, item, item_set_id):
+        return any(str(item_set.get('o:id')) == item_set_id for item_set in item.get('o:item_set', []))
+
+    def send_page(self, resources, query):
+        # paged like Omeka S, with the total in a header and a Link header to the next page
+        resources.sort(key=lambda r: r['o:id'], reverse=query.get('sort_order') == 'desc')
+        headers = {'Omeka-S-Total-Results': str(len(resources))}
+        per_page = int(query.get('per_page', 25))
+        page = int(query.get('page', 1))
+        if page * per_page < len(resources):
+            headers['Link'] = f'<{urlparse(self.path).path}?{urlencode(dict(query, page=page + 1))}>; rel="next"'
+        self.send(200, resources[(page - 1) * per_page:page * per_page], headers=headers)
+
+    def get(self, path, query):
+        if path in ('/properties', '/resource_classes'):
+            return self.send(200, [{'o:id': self.term_id(query.get('term', '')), 'o:term': query.get('term')}])
+        with self.state_lock:
+            if path == '/items':
+                items = list(self.state['items'].values())
+                if 'property[0][text]' in query:
+                    items = [i for i in items if any(s.get('@id') == query['property[0][text]'] for s in i.get(query.get('property[0][property]', 'schema:sameAs'), []))]
+                if 'item_set_id' in query:
+                    items = [i for i in items if self.in_item_set(i, query['item_set_id'])]
+                return self.send_page(items, query)
+            if path == '/media':
+                media = [m for m in self.state['media'].values() if 'item_id' not in query or str(m['o:item']['o:id']) == query['item_id']]
+                if 'item_set_id' in query:
+                    media = [m for m in media if self.in_item_set(self.state['items'][m['o:item']['o:id']], query['item_set_id'])]
+                return self.send_page(media, query)
+            if path == '/site_pages':
+                return self.send(200, [p for p in self.state['pages'].values() if 'slug' not in query or p.get('o:slug') == query['slug']])
+            match = re.match(r'/(items|media|mapping_markers|site_pages|sites)/(\d+)$', path)
+            if match:
+                collection = {'items': 'items', 'media': 'media', 'mapping_markers': 'markers', 'site_pages': 'pages', 'sites': 'sites'}[match.group(1)]
+                resource = self.state[collection].get(int(match.group(2)))
+                return self.send(200 if resource else 404, resource or {})
+        self.send(404, {})
+
+    def post(self, path, query):
+        if path == '/items':
+            item = json.loads(self.request_body())
+            with self.state_lock:
+                return self.send(200, self.store_item(item))
+        if path == '/media':
+            message = BytesParser().parsebytes(f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode() + self.request_body())
+            parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True) for part in message.get_payload()}
+            data = json.loads(parts['data'])
+            with self.state_lock:
+                id = self.new_id()
+                media = {'o:id': id, '@type': 'o:Media', 'o:ingester': data['o:ingester'], 'o:source': data.get('o:source'), 'o:size': len(parts.get('file[0]') or b''),
+                         'o:item': {'o:id': data['o:item']['o:id']}, 'thumbnail_display_urls': {'large': f'/files/large/{id}.jpg'}}
+                for key in ('dcterms:title', 'dcterms:identifier', 'o:alt_text'):
+                    if key in data:
+                        media[key] = data[key]
+                self.state['media'][id] = media
+                self.state['items'][data['o:item']['o:id']]['o:media'].append({'o:id': id})
+                return self.send(200, media)
+        if path == '/site_pages':
+            page = json.loads(self.request_body())
+            with self.state_lock:
+                page['o:id'] = self.new_id()
+                self.state['pages'][page['o:id']] = page
+                return self.send(200, page)
+        self.send(404, {})
+
+    def put(self, path, query):
+        match = re.match(r'/(items|site_pages)/(\d+)$', path)
+        if match:
+            resource = json.loads(self.request_body())
+            with self.state_lock:
+                if match.group(1) == 'items':
+                    return self.send(200, self.store_item(resource, int(match.group(2))))
+                resource['o:id'] = int(match.group(2))
+                self.state['pages'][resource['o:id']] = resource
+                return self.send(200, resource)
+        self.send(404, {})
+
+    def delete(self, path, query):
+        match = re.match(r'/media/(\d+)$', path)
+        if match:
+            with self.state_lock:
+                media = self.state['media'].pop(int(match.group(1)), None)
+                if media:
+                    item = self.state['items'][media['o:item']['o:id']]
+                    item['o:media'] = [m for m in item['o:media'] if m['o:id'] != media['o:id']]
+                return self.send(200 if media else 404, media or {})
+        self.send(404, {})
+
+
+def omeka_state(site_id = 1):
+    return {'next_id': 100, 'items': {}, 'media': {}, 'markers': {}, 'pages': {}, 'sites': {site_id: {'o:id': site_id, 'o:slug': 'benchmark', 'o:page': [], 'o:navigation': []}}}
+
+def serve(handler, port, latency = 0.0, jitter = 0.0, **attributes):
+    handler_class = type(handler.__name__, (handler,), dict(attributes, latency=latency, jitter=jitter, stats={}))
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+    server.daemon_threads = True
+    _logger.info(f'{handler.__name__} listening on port {server.server_address[1]}')
+    server.serve_forever()
+
+
+def main():
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    parser = argparse.ArgumentParser(description='Local Wikidata and Omeka S stand-ins for benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    corpus_parser = subparsers.add_parser('corpus', help='Write a synthetic corpus or record one from a wikiloader cache')
+    corpus_parser.add_argument('--output', required=True, help='Corpus file (.json.gz)')
+    corpus_parser.add_argument('--entities', type=int, default=100, help='Number of people in a synthetic corpus (default 100)')
+    corpus_parser.add_argument('--cache-path', help='Record the entities of this wikiloader cache instead')
+    corpus_parser.add_argument('--cache-backend', choices=entity_cache.cache_backends.keys(), default='files')
+    corpus_parser.add_argument('--id-file', help='People of the recorded corpus, one id per line')
+    for name in ['wikidata', 'omeka']:
+        server_parser = subparsers.add_parser(name, help=f'Serve the {name} stand-in')
+        server_parser.add_argument('--port', type=int, default=0)
+        server_parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+        server_parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many random seconds added to every response')
+        if name == 'wikidata':
+            server_parser.add_argument('--corpus', required=True, help='Corpus file written by the corpus command')
+    args = parser.parse_args()
+
+    if args.command == 'corpus':
+        if args.cache_path:
+            with open(args.id_file) as f:
+                people = [line.split()[0] for line in f if line.strip()]
+            corpus = record_corpus(args.cache_backend, args.cache_path, people)
+        else:
+            corpus = build_corpus(args.entities)
+        save_corpus(corpus, args.output)
+        _logger.info(f'Wrote {len(corpus["people"])} people and {len(corpus["entities"])} entities to {args.output}')
+    elif args.command == 'wikidata':
+        serve(wikidata_handler, args.port, args.latency, args.jitter, corpus=load_corpus(args.corpus))
+    else:
+        serve(omeka_handler, args.port, args.latency, args.jitter, state=omeka_state())
+
+if __name__ == '__main__':
+    main()
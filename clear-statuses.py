@@ -1,6 +1,7 @@
 import os
 import json
 import argparse
+import site_output
 
 def recursively_status(obj):
     remove_keys = ['status']
@@ -32,17 +33,21 @@ def clear_statuses(data_path):
                     recursively_status(v)
             else:
                 recursively_status(file_json)
-            with open(filename, 'w') as file:
-                file.write(json.dumps(file_json, indent = 4))
+            site_output.write_json(filename, file_json)
 
 def main():
     data_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wikidata-site/public/data')
     parser = argparse.ArgumentParser(description='Clear status information from data')
     parser.add_argument('--path', required=False, help='Path to json files')
+    parser.add_argument('--compact', action='store_true', help='Write JSON without indentation')
+    parser.add_argument('--precompress', action='store_true', help='Write .gz and .br copies of the JSON files')
     args = parser.parse_args()
     if args.path:
         data_path = args.path
+    site_output.compact_json = args.compact
     clear_statuses(data_path)
+    if args.precompress:
+        site_output.compress_directory(data_path)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
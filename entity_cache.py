@@ -0,0 +1,269 @@
+import os
+import json
+import gzip
+import hashlib
+import sqlite3
+import logging
+import argparse
+import threading
+
+_logger = logging.getLogger(__name__)
+
+sqlite_file_name = 'entities.sqlite'
+
+
+class file_entity_cache:
+    # one {id}.json.gz file per entity
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def file_path(self, id):
+        return os.path.join(self.path, f'{id}.json.gz')
+
+    def get(self, id):
+        cache_file = self.file_path(id)
+        if os.path.exists(cache_file):
+            with gzip.open(cache_file, 'rt') as cf:
+                try:
+                    return json.loads(cf.read())
+                except:
+                    _logger.error(f'Unable to read cache for {id}')
+
+    def get_many(self, ids):
+        entities = {}
+        for id in ids:
+            data = self.get(id)
+            if data:
+                entities[id] = data
+        return entities
+
+    def contains(self, ids):
+        return {id for id in ids if os.path.exists(self.file_path(id))}
+
+    def modified(self, id):
+        data = self.get(id)
+        if data:
+            return data.get('modified')
+
+    def revisions(self, ids):
+        return {id: data.get('lastrevid') for id, data in self.get_many(ids).items()}
+
+    def put(self, id, data):
+        cache_file = self.file_path(id)
+        # write to a temporary file first so concurrent workers never read a partial cache entry
+        temp_file = f'{cache_file}.{threading.get_ident()}.tmp'
+        with gzip.open(temp_file, 'wt') as cf:
+            cf.write(json.dumps(data))
+        os.replace(temp_file, cache_file)
+
+    def put_many(self, entities):
+        for id, data in entities.items():
+            self.put(id, data)
+
+    def ids(self):
+        return [f[:-len('.json.gz')] for f in os.listdir(self.path) if f.endswith('.json.gz')]
+
+    def derived_file_path(self, id):
+        return os.path.join(self.path, 'derived', f'{id}.json.gz')
+
+    def get_derived(self, id):
+        derived_file = self.derived_file_path(id)
+        if os.path.exists(derived_file):
+            with gzip.open(derived_file, 'rt') as df:
+                try:
+                    return json.loads(df.read())
+                except:
+                    _logger.error(f'Unable to read derived cache for {id}')
+
+    def put_derived(self, id, record):
+        derived_file = self.derived_file_path(id)
+        os.makedirs(os.path.dirname(derived_file), exist_ok=True)
+        temp_file = f'{derived_file}.{threading.get_ident()}.tmp'
+        with gzip.open(temp_file, 'wt') as df:
+            df.write(json.dumps(record))
+        os.replace(temp_file, derived_file)
+
+    def shape_file_path(self, name):
+        # shape titles contain spaces and slashes
+        return os.path.join(self.path, 'shapes', f'{hashlib.sha1(name.encode("utf-8")).hexdigest()}.json.gz')
+
+    def get_shape(self, name):
+        shape_file = self.shape_file_path(name)
+        if os.path.exists(shape_file):
+            with gzip.open(shape_file, 'rt') as sf:
+                try:
+                    return json.loads(sf.read())
+                except:
+                    _logger.error(f'Unable to read shape cache for {name}')
+
+    def put_shape(self, name, record):
+        shape_file = self.shape_file_path(name)
+        os.makedirs(os.path.dirname(shape_file), exist_ok=True)
+        temp_file = f'{shape_file}.{threading.get_ident()}.tmp'
+        with gzip.open(temp_file, 'wt') as sf:
+            sf.write(json.dumps(record))
+        os.replace(temp_file, shape_file)
+
+    def close(self):
+        pass
+
+
+class sqlite_entity_cache:
+    # a single sqlite file holding the modified timestamp and the gzipped entity json per id
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = os.path.join(path, sqlite_file_name)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entities (id TEXT PRIMARY KEY, modified TEXT, data BLOB, lastrevid INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS derived (id TEXT PRIMARY KEY, data BLOB)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS shapes (name TEXT PRIMARY KEY, data BLOB)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(entities)')]
+        if 'lastrevid' not in columns:
+            # caches created before revisions were tracked
+            self.connection.execute('ALTER TABLE entities ADD COLUMN lastrevid INTEGER')
+        self.connection.commit()
+
+    def get(self, id):
+        return self.get_many([id]).get(id)
+
+    def get_many(self, ids):
+        entities = {}
+        for id, payload in self._select('id, data', ids):
+            try:
+                entities[id] = json.loads(gzip.decompress(payload))
+            except:
+                _logger.error(f'Unable to read cache for {id}')
+        return entities
+
+    def contains(self, ids):
+        return {id for id, in self._select('id', ids)}
+
+    def modified(self, id):
+        rows = self._select('modified', [id])
+        if rows:
+            return rows[0][0]
+
+    def revisions(self, ids):
+        revisions = {id: lastrevid for id, lastrevid in self._select('id, lastrevid', ids)}
+        missing = [id for id, lastrevid in revisions.items() if lastrevid is None]
+        if missing:
+            # rows imported or written before the lastrevid column existed
+            revisions.update({id: data.get('lastrevid') for id, data in self.get_many(missing).items()})
+        return revisions
+
+    def put(self, id, data):
+        self.put_many({id: data})
+
+    def put_many(self, entities):
+        rows = [(id, data.get('modified'), gzip.compress(json.dumps(data).encode('utf-8'), compresslevel=6), data.get('lastrevid')) for id, data in entities.items()]
+        self.put_rows(rows)
+
+    def put_rows(self, rows):
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO entities (id, modified, data, lastrevid) VALUES (?, ?, ?, ?)', rows)
+            self.connection.commit()
+
+    def ids(self):
+        with self.lock:
+            return [id for id, in self.connection.execute('SELECT id FROM entities')]
+
+    def get_derived(self, id):
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM derived WHERE id = ?', (id,)).fetchone()
+        if row:
+            try:
+                return json.loads(gzip.decompress(row[0]))
+            except:
+                _logger.error(f'Unable to read derived cache for {id}')
+
+    def put_derived(self, id, record):
+        payload = gzip.compress(json.dumps(record).encode('utf-8'), compresslevel=6)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO derived (id, data) VALUES (?, ?)', (id, payload))
+            self.connection.commit()
+
+    def get_shape(self, name):
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM shapes WHERE name = ?', (name,)).fetchone()
+        if row:
+            try:
+                return json.loads(gzip.decompress(row[0]))
+            except:
+                _logger.error(f'Unable to read shape cache for {name}')
+
+    def put_shape(self, name, record):
+        payload = gzip.compress(json.dumps(record).encode('utf-8'), compresslevel=6)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO shapes (name, data) VALUES (?, ?)', (name, payload))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _select(self, columns, ids):
+        ids = list(dict.fromkeys(ids))
+        rows = []
+        with self.lock:
+            # stay below the sqlite bound parameter limit
+            for ix in range(0, len(ids), 500):
+                batch = ids[ix:ix + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows.extend(self.connection.execute(f'SELECT {columns} FROM entities WHERE id IN ({placeholders})', batch).fetchall())
+        return rows
+
+
+cache_backends = {
+    'files': file_entity_cache,
+    'sqlite': sqlite_entity_cache
+}
+
+def open_entity_cache(backend, path):
+    return cache_backends[backend](path)
+
+
+def import_files(source_path, target):
+    imported = 0
+    rows = []
+    for f in os.listdir(source_path):
+        if not f.endswith('.json.gz'):
+            continue
+        id = f[:-len('.json.gz')]
+        with open(os.path.join(source_path, f), 'rb') as cf:
+            payload = cf.read()
+        try:
+            data = json.loads(gzip.decompress(payload))
+        except:
+            _logger.error(f'Skipping unreadable cache file {f}')
+            continue
+        # the existing gzip payload is stored as is
+        rows.append((id, data.get('modified'), payload, data.get('lastrevid')))
+        if len(rows) >= 1000:
+            target.put_rows(rows)
+            imported += len(rows)
+            rows = []
+    target.put_rows(rows)
+    imported += len(rows)
+    return imported
+
+
+def main():
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    wiki_cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wiki-cache')
+    parser = argparse.ArgumentParser(description='Import a directory of cached .json.gz entities into the sqlite entity cache')
+    parser.add_argument('--source', required=False, help=f'Directory with .json.gz cache files (default {wiki_cache_path})')
+    parser.add_argument('--cache-path', required=False, help=f'Directory for {sqlite_file_name} (default {wiki_cache_path})')
+    args = parser.parse_args()
+    source_path = args.source or wiki_cache_path
+    target = sqlite_entity_cache(args.cache_path or wiki_cache_path)
+    imported = import_files(source_path, target)
+    target.close()
+    _logger.info(f'Imported {imported} entities from {source_path} into {target.path}')
+
+if __name__ == '__main__':
+    main()
@@ -12,11 +12,11 @@ def main():
         for entity in entity_list_json:
             entity_list_file.write(f'{entity['id']}\t{entity['label']}\n')
 
-    pattern = r'Q\d+?\.json'
+    pattern = r'Q\d+\.json'
     properties = {}
     images = []
     for f in os.listdir(data_path):
-        if re.match(pattern,f):
+        if re.fullmatch(pattern, f):
             entity_file_name = os.path.join(data_path, f)
             with open(entity_file_name, 'r') as entity_file:
                 entity_json = json.load(entity_file)
@@ -0,0 +1,170 @@
+import os
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import run_metrics
+
+_logger = logging.getLogger(__name__)
+
+max_retries = int(os.environ.get('HTTP_MAX_RETRIES', '5'))
+backoff_base = 1.0
+backoff_max = 60.0
+max_retry_after = 600.0
+# seconds to connect and to wait for data, without them a stalled connection blocks a worker and is never retried
+connect_timeout = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '10'))
+read_timeout = float(os.environ.get('HTTP_READ_TIMEOUT', '120'))
+
+retry_statuses = [429, 500, 502, 503, 504]
+idempotent_methods = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+# requests per second and burst per host, Wikimedia asks bots to keep a modest request rate and to back off when told to
+rate_limits = {
+    'www.wikidata.org': (10, 20),
+    'commons.wikimedia.org': (10, 20),
+    'upload.wikimedia.org': (10, 20),
+    'query.wikidata.org': (1, 5),
+}
+host_limits = {}
+host_limits_lock = threading.Lock()
+
+# base urls that stand in for a host, eg www.wikidata.org=http://127.0.0.1:8765 to run against a mirror or the benchmark stand-ins
+host_overrides = {}
+
+
+class host_limit:
+    def __init__(self, rate = None, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # every caller takes a token, a caller that takes it below zero sleeps until it has been refilled
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0, self.paused_until - now)
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.rate)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def set_rate_limit(host, rate, burst = None):
+    with host_limits_lock:
+        rate_limits[host] = (rate, burst or max(1, rate))
+        host_limits.pop(host, None)
+
+def parse_rate_limit(value):
+    # host=rate or host=rate/burst
+    host, limit = value.split('=', 1)
+    rate, _, burst = limit.partition('/')
+    return host, float(rate), float(burst) if burst else None
+
+def override_url(url):
+    parsed = urlparse(url)
+    base = host_overrides.get(parsed.hostname)
+    if not base:
+        return url
+    return base.rstrip('/') + url[len(f'{parsed.scheme}://{parsed.netloc}'):]
+
+def get_host_limit(url):
+    host = urlparse(url).hostname
+    with host_limits_lock:
+        if host not in host_limits:
+            host_limits[host] = host_limit(*rate_limits.get(host, (None, 1)))
+        return host_limits[host]
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max_retry_after, max(0, seconds))
+
+def backoff_delay(attempt):
+    delay = min(backoff_max, backoff_base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class resilient_session(requests.Session):
+    # retries happen in send so redirects and prepared bodies such as multipart uploads are sent again unchanged
+    def send(self, request, **kwargs):
+        # the rate limit of the original host also applies to its stand-in
+        limit = get_host_limit(request.url)
+        request.url = override_url(request.url)
+        idempotent = request.method in idempotent_methods
+        # Session.request passes timeout=None when the caller did not set one
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (connect_timeout, read_timeout)
+        attempt = 0
+        while True:
+            throttled = limit.wait()
+            start = time.perf_counter()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                run_metrics.record_request(request.method, request.url, type(e).__name__, 0, start, time.perf_counter() - start, throttled)
+                # a request that may have reached the server is only repeated when that is harmless
+                if attempt >= max_retries or not (idempotent or isinstance(e, requests.ConnectTimeout)):
+                    raise
+                delay = backoff_delay(attempt)
+                _logger.warning(f'{request.method} {request.url} failed ({e}), retrying in {delay:.1f}s')
+            else:
+                # a streamed body is not read yet, its size is taken from the headers
+                size = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content)
+                run_metrics.record_request(request.method, request.url, response.status_code, size, start, time.perf_counter() - start, throttled)
+                if response.status_code not in retry_statuses or attempt >= max_retries or not (idempotent or response.status_code == 429):
+                    return response
+                delay = retry_after(response)
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                else:
+                    limit.pause(delay)
+                _logger.warning(f'{request.method} {request.url} returned {response.status_code}, retrying in {delay:.1f}s')
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+def mount_pools(session, size):
+    # one pool of up to size connections for each host
+    adapter = HTTPAdapter(pool_connections=max(10, size), pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+def session(headers = None, pool_size = 10):
+    http_session = resilient_session()
+    if headers:
+        http_session.headers.update(headers)
+    mount_pools(http_session, pool_size)
+    return http_session
+
+
+for value in filter(None, os.environ.get('HTTP_RATE_LIMITS', '').split(',')):
+    set_rate_limit(*parse_rate_limit(value))
+for value in filter(None, os.environ.get('HTTP_HOST_OVERRIDES', '').split(',')):
+    host, base = value.split('=', 1)
+    host_overrides[host] = base
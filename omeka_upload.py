@@ -3,13 +3,18 @@ import re
 import json
 import markdown
 from bs4 import BeautifulSoup
-import requests
 import math
 import string
 import logging
 from PIL import Image
 from io import StringIO
+import http_transport
+import run_metrics
+import site_output
 import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 OMEKA_KEY=os.environ.get('OMEKA_KEY')
 OMEKA_CRED=os.environ.get('OMEKA_CRED')
@@ -21,18 +26,53 @@ OMEKA_ITEMSET_TITLE=os.environ.get('OMEKA_ITEMSET_TITLE')
 OMEKA_MAPPING_FEATURE='marker'
 UPDATE_SITE=False
 MAX_OBJECTS=5
+OMEKA_UPLOAD_WORKERS=int(os.environ.get('OMEKA_UPLOAD_WORKERS', '1'))
+OMEKA_PAGE_SIZE=int(os.environ.get('OMEKA_PAGE_SIZE', '100'))
+OMEKA_ITEM_INDEX=os.environ.get('OMEKA_ITEM_INDEX')
+OMEKA_LEDGER=os.environ.get('OMEKA_LEDGER')
+OMEKA_FETCH_WORKERS=int(os.environ.get('OMEKA_FETCH_WORKERS', '8'))
+OMEKA_METRICS=os.environ.get('OMEKA_METRICS')
+OMEKA_TRACE=os.environ.get('OMEKA_TRACE')
 
 important_places_title = 'Important Places'
 
 
 _logger = logging.getLogger(__name__)
+run_metrics.trace_enabled = bool(OMEKA_TRACE)
 
 data_path = None
+# a copy of every uploaded image is kept here
+images_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'images')
 resources = {}
 resources_by_itemid = {}
 property_values_with_mapping = set()
 description_by_label = {}
 
+# people uploaded by load_data, a relative has to be saved before an entity later in the upload order looks it up
+upload_positions = {}
+saved_people = {}
+upload_state = threading.local()
+# place resources are resolved by one worker at a time so each place is only created once
+resource_locks = {}
+resource_locks_lock = threading.Lock()
+
+# items of the item set by wikidata id, loaded with paged /items calls instead of one search per lookup
+item_index = None
+item_index_lock = threading.Lock()
+# the saved index is not updated by edits in the Omeka admin
+item_index_saved = False
+
+# media of the item set by o:id, loaded once with paged /media calls and shared by the page generators of update_site
+media_index = {}
+media_index_loaded = False
+
+# data of the referenced entities when wikiloader wrote it once to refs/ instead of into every value (--refs shared)
+entity_refs = None
+entity_refs_lock = threading.Lock()
+
+# fingerprint, o:id and o:modified of the last payload pushed for each wikidata id, saved to OMEKA_LEDGER between runs
+pushed_resources = {}
+
 
 def load_config_file(file_name):
     with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), file_name)) as f:
@@ -46,8 +86,7 @@ resource_class_precedence = ['schema:EducationalOrganization', 'schema:Organizat
 
 
 ua_headers = {'User-Agent': 'YaleLibraryDownloader/0.0 (https://library.yale.edu; library@yale.edu)'}
-requests_session = requests.Session()
-requests_session.headers.update(ua_headers)
+requests_session = http_transport.session(ua_headers)
 
 def omeka_api_get(uri, params = {}):
     params['key_identity'] = OMEKA_KEY
@@ -95,6 +134,41 @@ def omeka_api_put(uri, params, object):
     else:
         _logger.error(response.text)
 
+def omeka_api_page(uri, params):
+    response = requests_session.get(f'{OMEKA_API}{uri}', params = params, headers = {'Accept':'application/json', 'Content-Type': 'application/json'})
+    if not response.status_code == 200:
+        _logger.error(response.text)
+        return None, False
+    resources = response.json()
+    # Omeka S sends a Link header and Omeka-S-Total-Results, a full page is the last resort
+    if response.links:
+        has_next = 'next' in response.links
+    elif 'Omeka-S-Total-Results' in response.headers:
+        has_next = params['page'] * params['per_page'] < int(response.headers['Omeka-S-Total-Results'])
+    else:
+        has_next = len(resources) == params['per_page']
+    return resources, has_next
+
+def omeka_api_pages(uri, params = {}, per_page = None, prefetch = True):
+    # yields one page of resources at a time, None when a request failed; the next page is requested while the caller works on this one
+    params = dict(params, key_identity = OMEKA_KEY, key_credential = OMEKA_CRED, per_page = per_page or OMEKA_PAGE_SIZE, page = 1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        resources, has_next = omeka_api_page(uri, dict(params))
+        while True:
+            next_page = None
+            if has_next:
+                params['page'] += 1
+                if prefetch:
+                    next_page = executor.submit(omeka_api_page, uri, dict(params))
+            yield resources
+            if resources is None or not has_next:
+                return
+            resources, has_next = next_page.result() if next_page else omeka_api_page(uri, dict(params))
+
+def omeka_api_list(uri, params = {}, per_page = None, prefetch = True):
+    for resources in omeka_api_pages(uri, params, per_page, prefetch):
+        yield from resources or []
+
 class property_ids_dict(dict):
     def __missing__(self, key):
         result = omeka_api_get('/properties', {'term': key})
@@ -130,8 +204,31 @@ item_ids_by_slug = {}
 def name_to_slug(name):
     return name.translate(str.maketrans('', '', string.punctuation)).lower().replace(' ', '_')
 
-def upload_media_for_item(item_id, citation, name, image_path):
+def media_content_hash(*parts):
+    content_hash = hashlib.sha256()
+    for part in parts:
+        content_hash.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+    return content_hash.hexdigest()
+
+def media_identifier(content_hash):
+    # the content hash is stored on the media record so later runs can tell which media are unchanged
+    return [{'type': 'literal', 'property_id': property_ids['dcterms:identifier'], 'property_label': 'Identifier', 'is_public': False, '@value': f'sha256:{content_hash}'}]
+
+def existing_media_hash(media):
+    for identifier in media.get('dcterms:identifier', []):
+        value = identifier.get('@value') or ''
+        if value.startswith('sha256:'):
+            return value[len('sha256:'):]
+
+def media_signature(media):
+    if media.get('o:ingester') == 'html':
+        return ('html', (media.get('dcterms:title') or [{}])[0].get('@value'))
+    return (media.get('o:ingester'), media.get('o:source'))
+
+def upload_media_for_item(item_id, citation, name, image_path, content_hash = None):
     object = { 'o:ingester': 'upload', 'file_index': 0, 'o:item': {'o:id': item_id}, 'o:source': f'{name} - {citation}', 'o:alt_text': f'{name} - {citation}'}
+    if content_hash:
+        object['dcterms:identifier'] = media_identifier(content_hash)
     multipart_form_data = {'file[0]': (os.path.basename(image_path), open(image_path, 'rb'))}
     uri = f'/media?key_identity={OMEKA_KEY}&key_credential={OMEKA_CRED}'
     params = {'data': json.dumps(object)}
@@ -142,7 +239,7 @@ def upload_media_for_item(item_id, citation, name, image_path):
     return response.json()
 
 
-def upload_html_for_item(item_id, title, html):
+def upload_html_for_item(item_id, title, html, content_hash = None):
     soup = BeautifulSoup(html, features='html.parser')
     txt = soup.get_text()
     object = { 'o:ingester': 'html', 'o:renderer': 'html', 'file_index': 0, 'o:item': {'o:id': item_id},
@@ -165,6 +262,8 @@ def upload_html_for_item(item_id, title, html):
         }
     ],
     'html': html}
+    if content_hash:
+        object['dcterms:identifier'] = media_identifier(content_hash)
     multipart_form_data = {'file[0]': (f'html', StringIO(html))}
     uri = f'/media?key_identity={OMEKA_KEY}&key_credential={OMEKA_CRED}'
     params = {'data': json.dumps(object)}
@@ -174,7 +273,70 @@ def upload_html_for_item(item_id, title, html):
         exit(1)
     return response.json()
 
+def item_wikidata_id(item):
+    for same_as in item.get('schema:sameAs', []):
+        match = re.match(r'^https://www.wikidata.org/wiki/(Q\d+)$', same_as.get('@id') or '')
+        if match:
+            return match.group(1)
+
+def load_item_index():
+    index = {}
+    for items in omeka_api_pages('/items', {'item_set_id': OMEKA_ITEM_SET, 'sort_by': 'id', 'sort_order': 'asc'}):
+        if items is None:
+            _logger.error('Unable to load the item index, searching items one at a time')
+            return None
+        for item in items:
+            wikidata_id = item_wikidata_id(item)
+            if wikidata_id:
+                # the search returned the oldest matching item
+                index.setdefault(wikidata_id, item)
+    _logger.info(f'Loaded {len(index)} items of item set {OMEKA_ITEM_SET}')
+    return index
+
+def latest_item_id():
+    items = omeka_api_get('/items', {'item_set_id': OMEKA_ITEM_SET, 'sort_by': 'id', 'sort_order': 'desc', 'per_page': 1})
+    if items:
+        return items[0]['o:id']
+
+def load_saved_item_index():
+    # a saved index is only used while nobody else added items to the set, delete it after editing items in the Omeka admin
+    if not OMEKA_ITEM_INDEX or not os.path.exists(OMEKA_ITEM_INDEX):
+        return None
+    with open(OMEKA_ITEM_INDEX) as f:
+        saved = json.load(f)
+    if saved.get('item_set') != OMEKA_ITEM_SET or saved.get('latest_item_id') != latest_item_id():
+        return None
+    _logger.info(f'Using {len(saved["items"])} items from {OMEKA_ITEM_INDEX}')
+    return saved['items']
+
+def save_item_index():
+    if not OMEKA_ITEM_INDEX or item_index is None:
+        return
+    with item_index_lock:
+        saved = {'item_set': OMEKA_ITEM_SET, 'latest_item_id': latest_item_id(), 'items': item_index}
+        with open(OMEKA_ITEM_INDEX, 'w') as f:
+            json.dump(saved, f)
+
+def get_item_index():
+    global item_index, item_index_saved
+    with item_index_lock:
+        if item_index is None and OMEKA_ITEM_SET:
+            with run_metrics.stage('item index'):
+                item_index = load_saved_item_index()
+                item_index_saved = bool(item_index)
+                if not item_index_saved:
+                    item_index = load_item_index()
+    return item_index
+
+def index_item(wikidata_id, item):
+    if item_index is not None:
+        with item_index_lock:
+            item_index[wikidata_id] = item
+
 def load_item_by_wikidata_id(wikidata_id):
+    index = get_item_index()
+    if index is not None:
+        return index.get(wikidata_id)
     params = {
         'property[0][property]': 'schema:sameAs',
         'property[0][text]': f'https://www.wikidata.org/wiki/{wikidata_id}',
@@ -183,6 +345,47 @@ def load_item_by_wikidata_id(wikidata_id):
     if results:
         return results[0]
 
+def load_media_index():
+    for media in omeka_api_pages('/media', {'item_set_id': OMEKA_ITEM_SET, 'sort_by': 'id', 'sort_order': 'asc'}):
+        if media is None:
+            _logger.error('Unable to load the media index, fetching media one at a time')
+            return
+        for media_data in media:
+            media_index[media_data['o:id']] = media_data
+    _logger.info(f'Loaded {len(media_index)} media of item set {OMEKA_ITEM_SET}')
+
+def load_entity_refs():
+    global entity_refs
+    with entity_refs_lock:
+        if entity_refs is None:
+            entity_refs = site_output.read_refs(os.path.join(data_path, 'refs'))
+    return entity_refs
+
+def get_media(media_ids):
+    global media_index_loaded
+    if not media_index_loaded and OMEKA_ITEM_SET:
+        media_index_loaded = True
+        with run_metrics.stage('media index'):
+            load_media_index()
+    missing = [media_id for media_id in media_ids if media_id not in media_index]
+    run_metrics.record_cache('media index', 'hit', len(media_ids) - len(missing))
+    run_metrics.record_cache('media index', 'miss', len(missing))
+    if missing:
+        with ThreadPoolExecutor(max_workers=OMEKA_FETCH_WORKERS) as executor:
+            for media_id, media_data in zip(missing, executor.map(lambda media_id: omeka_api_get(f'/media/{media_id}', {}), missing)):
+                if media_data:
+                    media_index[media_id] = media_data
+    return {media_id: media_index.get(media_id) for media_id in media_ids}
+
+def wait_for_person(wikidata_id):
+    position = upload_positions.get(wikidata_id)
+    if position is not None and position < getattr(upload_state, 'position', -1):
+        saved_people[wikidata_id].wait()
+
+def resource_lock(wikidata_id):
+    with resource_locks_lock:
+        return resource_locks.setdefault(wikidata_id, threading.Lock())
+
 def value_to_omeka_property(label, property_value):
     value =  property_value['text']
     if value.startswith('http'):
@@ -193,6 +396,7 @@ def value_to_omeka_property(label, property_value):
     if relationship == 'schema:relatedTo':
         if property_value['value-type'] == 'wikibase-item':
             # this relies on the related item to have been previously loaded
+            wait_for_person(property_value['id'])
             relative =  load_item_by_wikidata_id(property_value['id'])
             if relative:
                 prop =  {'type': 'resource', 'property_label': label.title(), 'value_resource_id': relative['o:id'], 'value_resource_name': 'items', 'display_title': property_value['text'], 'property_id': property_ids[property_map[label]]}
@@ -219,40 +423,41 @@ def value_to_omeka_property(label, property_value):
             _logger.info(f'Skipping organization: {value}')
             return None
 
-        existing_resource = resources.get(property_value['id'])
-        if existing_resource:
-            type = existing_resource['@type']
-            if resource_class_precedence.index(resource_class) < resource_class_precedence.index(type):
-                existing_resource['o:resource_class'] = {'oid': resource_class_ids[resource_class]}
-                _logger.info(f'updating resource {property_value["id"]} to {resource_class} from {type} as id {resource_class_ids[resource_class]}')
-            oid = save_resource(property_value['id'], existing_resource)['o:id']
-        else: # new resource
-            resource = {
-                    'o:title': property_value['text'],
-                    '@type': resource_class,
-                    'o:resource_class': {'o:id':resource_class_ids[resource_class]},
-                    'o:item_set': [{'o:id': OMEKA_ITEM_SET}],
-                    # 'o:site': [{'o:id': OMEKA_SITE}],
-                    'dcterms:title': [{'@value': property_value['text'], 'type': 'literal', 'property_label': 'Title', 'property_id': property_ids['dcterms:title']}],
-                    'schema:sameAs': [{'type': 'uri', '@id': f'https://www.wikidata.org/wiki/{property_value["id"]}', 'o:label': 'Wikidata', 'property_id': property_ids['schema:sameAs']}]
-            }
-            resources[property_value['id']] = resource
-            coordinates = property_value.get('data', {}).get('properties', {}).get('coordinate location')
-            if coordinates:
-                resource['o-module-mapping:mapping'] = {'@type': 'o-module-mapping:Map', 'o-module-mapping:bounds': get_bounding_box(coordinates['values'][0]['latitude'], coordinates['values'][0]['longitude'], 100)}
-                resource[f'o-module-mapping:{OMEKA_MAPPING_FEATURE}'] = [{
-                    '@type': f'o-module-mapping:{OMEKA_MAPPING_FEATURE.title()}', 'o-module-mapping:geography-type': 'Point'
-                }]
-                feature = resource[f'o-module-mapping:{OMEKA_MAPPING_FEATURE}'][0]
-                if OMEKA_MAPPING_FEATURE == 'marker':
-                    feature['o-module-mapping:lng'] = coordinates['values'][0]['longitude']
-                    feature['o-module-mapping:lat'] = coordinates['values'][0]['latitude']
-                    feature['o-module-mapping:label'] = property_value['text']
-                else:
-                    feature['o-module-mapping:geography-coordinates'] = [coordinates['values'][0]['longitude'], coordinates['values'][0]['latitude']]
-            oid = save_resource(property_value['id'], resource)['o:id']
-            if coordinates:
-                property_values_with_mapping.add(oid)
+        with resource_lock(property_value['id']):
+            existing_resource = resources.get(property_value['id'])
+            if existing_resource:
+                type = existing_resource['@type']
+                if resource_class_precedence.index(resource_class) < resource_class_precedence.index(type):
+                    existing_resource['o:resource_class'] = {'oid': resource_class_ids[resource_class]}
+                    _logger.info(f'updating resource {property_value["id"]} to {resource_class} from {type} as id {resource_class_ids[resource_class]}')
+                oid = save_resource(property_value['id'], existing_resource)['o:id']
+            else: # new resource
+                resource = {
+                        'o:title': property_value['text'],
+                        '@type': resource_class,
+                        'o:resource_class': {'o:id':resource_class_ids[resource_class]},
+                        'o:item_set': [{'o:id': OMEKA_ITEM_SET}],
+                        # 'o:site': [{'o:id': OMEKA_SITE}],
+                        'dcterms:title': [{'@value': property_value['text'], 'type': 'literal', 'property_label': 'Title', 'property_id': property_ids['dcterms:title']}],
+                        'schema:sameAs': [{'type': 'uri', '@id': f'https://www.wikidata.org/wiki/{property_value["id"]}', 'o:label': 'Wikidata', 'property_id': property_ids['schema:sameAs']}]
+                }
+                resources[property_value['id']] = resource
+                coordinates = property_value.get('data', {}).get('properties', {}).get('coordinate location')
+                if coordinates:
+                    resource['o-module-mapping:mapping'] = {'@type': 'o-module-mapping:Map', 'o-module-mapping:bounds': get_bounding_box(coordinates['values'][0]['latitude'], coordinates['values'][0]['longitude'], 100)}
+                    resource[f'o-module-mapping:{OMEKA_MAPPING_FEATURE}'] = [{
+                        '@type': f'o-module-mapping:{OMEKA_MAPPING_FEATURE.title()}', 'o-module-mapping:geography-type': 'Point'
+                    }]
+                    feature = resource[f'o-module-mapping:{OMEKA_MAPPING_FEATURE}'][0]
+                    if OMEKA_MAPPING_FEATURE == 'marker':
+                        feature['o-module-mapping:lng'] = coordinates['values'][0]['longitude']
+                        feature['o-module-mapping:lat'] = coordinates['values'][0]['latitude']
+                        feature['o-module-mapping:label'] = property_value['text']
+                    else:
+                        feature['o-module-mapping:geography-coordinates'] = [coordinates['values'][0]['longitude'], coordinates['values'][0]['latitude']]
+                oid = save_resource(property_value['id'], resource)['o:id']
+                if coordinates:
+                    property_values_with_mapping.add(oid)
         prop =  {'type': 'resource', 'property_label': label.title(), 'value_resource_id': oid, 'value_resource_name': 'items', 'display_title': property_value['text'], 'property_id': property_ids[property_map[label]]}
         add_annotations(prop, label, property_value)
         return prop
@@ -282,8 +487,51 @@ def add_annotations(prop, label, property_value):
         }
     return prop
 
+def resource_fingerprint(resource):
+    # without the ids save_resource copies from the existing item
+    resource = {k: v for k, v in resource.items() if k != 'o:id'}
+    if 'o-module-mapping:mapping' in resource:
+        resource['o-module-mapping:mapping'] = {k: v for k, v in resource['o-module-mapping:mapping'].items() if k != 'o:id'}
+    if f'o-module-mapping:{OMEKA_MAPPING_FEATURE}' in resource:
+        resource[f'o-module-mapping:{OMEKA_MAPPING_FEATURE}'] = [{k: v for k, v in feature.items() if k != 'o:id'} for feature in resource[f'o-module-mapping:{OMEKA_MAPPING_FEATURE}']]
+    return hashlib.sha256(json.dumps(resource, sort_keys=True).encode('utf-8')).hexdigest()
+
+def item_modified(item):
+    return (item.get('o:modified') or {}).get('@value')
+
+def load_ledger():
+    if OMEKA_LEDGER and os.path.exists(OMEKA_LEDGER):
+        with open(OMEKA_LEDGER) as f:
+            pushed_resources.update(json.load(f))
+
+def save_ledger():
+    if not OMEKA_LEDGER:
+        return
+    with open(OMEKA_LEDGER, 'w') as f:
+        json.dump({id: {k: v for k, v in pushed.items() if k != 'response'} for id, pushed in pushed_resources.items()}, f)
+
 def save_resource(resource_id, resource):
+    fingerprint = resource_fingerprint(resource)
+    pushed = pushed_resources.get(resource_id)
+    if pushed and pushed['fingerprint'] == fingerprint and pushed.get('response'):
+        # already written during this run
+        run_metrics.record_cache('item saves', 'hit')
+        return pushed['response']
     existing_item = load_item_by_wikidata_id(resource_id)
+    unchanged = pushed and pushed['fingerprint'] == fingerprint and existing_item and existing_item['o:id'] == pushed['o:id']
+    if unchanged and item_index_saved:
+        # the o:modified of the current item tells whether it was edited in Omeka since the last run
+        current_item = omeka_api_get(f'/items/{existing_item["o:id"]}')
+        unchanged = current_item is not None
+        existing_item = current_item or existing_item
+    if unchanged and item_modified(existing_item) == pushed['modified']:
+        # unchanged since the last run and not edited in Omeka since
+        _logger.debug(f'No changes for {resource_id}')
+        run_metrics.record_cache('item saves', 'hit')
+        pushed['response'] = existing_item
+        resources_by_itemid[f'{existing_item["o:id"]}'] = existing_item
+        return existing_item
+    run_metrics.record_cache('item saves', 'miss')
     if not existing_item:
         response = omeka_api_post('/items', {}, resource)
         if not response:
@@ -305,88 +553,152 @@ def save_resource(resource_id, resource):
             _logger.error('Unable to save resource')
             exit(2)
     resources_by_itemid[f'{response["o:id"]}'] = response
+    index_item(resource_id, response)
+    pushed_resources[resource_id] = {'o:id': response['o:id'], 'modified': item_modified(response), 'fingerprint': fingerprint, 'response': response}
     return response
 
 
+def upload_media(item_id, dt):
+    with run_metrics.stage('media upload'):
+        existing_media = []
+        for media in omeka_api_pages('/media', {'item_id': item_id, 'sort_by': 'id', 'sort_order': 'asc'}, prefetch = False):
+            if media is None:
+                # uploading without knowing the existing media would add copies of them
+                _logger.error(f'Unable to list the media of item {item_id}, skipping its media')
+                return
+            existing_media.extend(media)
+        media_by_hash = {existing_media_hash(media): media for media in existing_media if existing_media_hash(media)}
+        kept_media = []
+        upload_images(item_id, dt, media_by_hash, kept_media)
+        if 'biography_html' in dt:
+            sync_html_for_item(item_id, 'Biography', dt['biography_html'], media_by_hash, kept_media)
+        if 'publications_html' in dt:
+            sync_html_for_item(item_id, 'Publications', dt['publications_html'], media_by_hash, kept_media)
+            #_logger.info(f'Added publication to {dt["name"]}')
+        remove_replaced_media(existing_media, kept_media)
+
+def sync_html_for_item(item_id, title, html, media_by_hash, kept_media):
+    content_hash = media_content_hash(title, html)
+    media = media_by_hash.pop(content_hash, None)
+    run_metrics.record_cache('media uploads', 'hit' if media else 'miss')
+    if not media:
+        media = upload_html_for_item(item_id, title, html, content_hash)
+    kept_media.append(media)
+
+def remove_replaced_media(existing_media, kept_media):
+    # media written by this script that were not kept were replaced, this includes copies uploaded before media had content hashes
+    kept_ids = {media['o:id'] for media in kept_media}
+    kept_signatures = {media_signature(media) for media in kept_media}
+    for media in existing_media:
+        if media['o:id'] not in kept_ids and (existing_media_hash(media) or media_signature(media) in kept_signatures):
+            _logger.info(f'Removing replaced media {media["o:id"]}')
+            omeka_api_delete(f'/media/{media["o:id"]}', {})
+
+def upload_entity(entity_file_name, position, media_executor = None):
+    entity_id = os.path.basename(entity_file_name).replace('.json', '')
+    upload_state.position = position
+    try:
+        with open(entity_file_name, 'r') as entity_file:
+            entity_json = site_output.inline_refs(json.load(entity_file), load_entity_refs())
+            dt = {'id': entity_json['id']}
+            if 'biographyMarkdown' in entity_json:
+                md = entity_json['biographyMarkdown']
+                md = md.split('\n', 1)[1] if '\n' in md else md
+                image_citations = re.findall("^Image citation:.*$", md, re.MULTILINE)
+                if image_citations:
+                    md = re.sub("\nImage citation:.*$", "", md, flags=re.MULTILINE)
+                    dt['image_citations'] = image_citations
+                dt['biography_html'] = markdown.markdown(md, extensions=['extra']).replace('h2>', 'h3>')
+                if 'footnote' in dt['biography_html']:
+                    dt['biography_html'] = '<style>.footnote {font-size:0.9em} .footnote p {margin: 0}</style>' + dt['biography_html']
+            if 'publicationsMarkdown' in entity_json:
+                dt['publications_html'] = f'<h3>Publications</h3>{markdown.markdown(entity_json["publicationsMarkdown"], extensions=["extra"])}'
+            dt['name'] = entity_json['label']
+
+            dt['item'] = {
+                'o:item_set': [{'o:id': OMEKA_ITEM_SET}],
+                'o:site': [{'o:id': OMEKA_SITE}],
+                'o:resource_class': {'o:id':resource_class_ids['schema:Person']},
+                'o:title': [{'@value': entity_json['label'], 'type': 'literal', 'property_id': property_ids['dcterms:title']}],
+                'foaf:name': [{'type': 'literal', '@value': entity_json['label'], 'property_id': property_ids['foaf:name']}]
+            }
+            if 'description' in entity_json:
+                dt['item']['dcterms:description'] = [{'type': 'literal', '@value': entity_json['description'], 'property_id': property_ids['dcterms:description']}]
+                description_by_label[entity_json['label']] = entity_json.get('description')
+            for property in entity_json.get('properties', {}).values():
+                if property['label'] == 'image':
+                    if 'values' in property:
+                        for property_value in property['values']:
+                            if property_value.get('value-type') == 'commonsMedia':
+                                for image_info in property_value.get('image-info', []):
+                                    if 'url' in image_info:
+                                        if not 'images' in dt:
+                                            dt['images'] = []
+                                        dt['images'].append({'url': image_info['url'], 'name': property_value['name']})
+                else:
+                    label = property['label']
+                    dt['item'][property_map[label]] = []
+                    if 'values' in property:
+                        for property_value in property['values']:
+                            if 'text' in property_value:
+                                val = value_to_omeka_property(label, property_value)
+                                if val:
+                                    dt['item'][property_map[label]].append(val)
+                            else:
+                                _logger.error(f'Unable to find text in property {label}')
+                                exit(5)
+            dt['item']['schema:sameAs'] = [{ 'type': 'uri',
+                    '@id': f'https://www.wikidata.org/wiki/{entity_json["id"]}',
+                    'o:label': 'Wikidata',
+                    'property_id': property_ids['schema:sameAs']
+                    }]
+            add_properties_with_location_to_map(dt['item'])
+            omeka_item = save_resource(entity_json['id'], dt['item'])
+            item_id = omeka_item['o:id']
+            title = dt['item']['o:title'][0]['@value']
+            item_ids_by_slug[name_to_slug(title)] = item_id
+            #_logger.info(f'Uploaded {entity_json["label"]}  {item_id}')
+    finally:
+        saved_people[entity_id].set()
+    # the media of one item are uploaded in order, the Omeka item shows them in that order
+    if media_executor:
+        return media_executor.submit(upload_media, item_id, dt)
+    upload_media(item_id, dt)
+
+def results_in_order(futures):
+    # stop the remaining uploads as soon as one fails, exit() in a worker reaches the main thread here
+    results = []
+    try:
+        for future in futures:
+            results.append(future.result())
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return results
+
 def load_data():
-    global description_by_label
-    pnames = set()
-    pattern = r'Q\d+?\.json'
+    load_ledger()
+    pattern = r'Q\d+\.json'
     #pattern = r'Q7108504.json'
-    cnt = 0
-    for f in os.listdir(data_path):
-        if re.match(pattern,f):
-            entity_file_name = os.path.join(data_path, f)
-            with open(entity_file_name, 'r') as entity_file:
-                entity_json = json.load(entity_file)
-                dt = {'id': entity_json['id']}
-                if 'biographyMarkdown' in entity_json:
-                    md = entity_json['biographyMarkdown']
-                    md = md.split('\n', 1)[1] if '\n' in md else md
-                    image_citations = re.findall("^Image citation:.*$", md, re.MULTILINE)
-                    if image_citations:
-                        md = re.sub("\nImage citation:.*$", "", md, flags=re.MULTILINE)
-                        dt['image_citations'] = image_citations
-                    dt['biography_html'] = markdown.markdown(md, extensions=['extra']).replace('h2>', 'h3>')
-                    if 'footnote' in dt['biography_html']:
-                        dt['biography_html'] = '<style>.footnote {font-size:0.9em} .footnote p {margin: 0}</style>' + dt['biography_html']
-                if 'publicationsMarkdown' in entity_json:
-                    dt['publications_html'] = f'<h3>Publications</h3>{markdown.markdown(entity_json["publicationsMarkdown"], extensions=["extra"])}'
-                dt['name'] = entity_json['label']
-
-                dt['item'] = {
-                    'o:item_set': [{'o:id': OMEKA_ITEM_SET}],
-                    'o:site': [{'o:id': OMEKA_SITE}],
-                    'o:resource_class': {'o:id':resource_class_ids['schema:Person']},
-                    'o:title': [{'@value': entity_json['label'], 'type': 'literal', 'property_id': property_ids['dcterms:title']}],
-                    'foaf:name': [{'type': 'literal', '@value': entity_json['label'], 'property_id': property_ids['foaf:name']}]
-                }
-                if 'description' in entity_json:
-                    dt['item']['dcterms:description'] = [{'type': 'literal', '@value': entity_json['description'], 'property_id': property_ids['dcterms:description']}]
-                    description_by_label[entity_json['label']] = entity_json.get('description')
-                for property in entity_json.get('properties', {}).values():
-                    if property['label'] == 'image':
-                        if 'values' in property:
-                            for property_value in property['values']:
-                                if property_value.get('value-type') == 'commonsMedia':
-                                    for image_info in property_value.get('image-info', []):
-                                        if 'url' in image_info:
-                                            if not 'images' in dt:
-                                                dt['images'] = []
-                                            dt['images'].append({'url': image_info['url'], 'name': property_value['name']})
-                    else:
-                        label = property['label']
-                        pnames.add(label)
-                        dt['item'][property_map[label]] = []
-                        if 'values' in property:
-                            for property_value in property['values']:
-                                if 'text' in property_value:
-                                    val = value_to_omeka_property(label, property_value)
-                                    if val:
-                                        dt['item'][property_map[label]].append(val)
-                                else:
-                                    _logger.error(f'Unable to find text in property {label}')
-                                    exit(5)
-                dt['item']['schema:sameAs'] = [{ 'type': 'uri',
-                        '@id': f'https://www.wikidata.org/wiki/{entity_json["id"]}',
-                        'o:label': 'Wikidata',
-                        'property_id': property_ids['schema:sameAs']
-                        }]
-                add_properties_with_location_to_map(dt['item'])
-                omeka_item = save_resource(entity_json['id'], dt['item'])
-                item_id = omeka_item['o:id']
-                upload_images(item_id, dt)
-                if 'biography_html' in dt:
-                    upload_html_for_item(item_id, 'Biography', dt['biography_html'])
-                if 'publications_html' in dt:
-                    upload_html_for_item(item_id, 'Publications', dt['publications_html'])
-                    #_logger.info(f'Added publication to {entity_json["label"]}')
-                title = dt['item']['o:title'][0]['@value']
-                item_ids_by_slug[name_to_slug(title)] = item_id
-                #_logger.info(f'Uploaded {entity_json["label"]}  {item_id}')
-                cnt += 1
-                if cnt > MAX_OBJECTS:
-                    exit(0)
+    file_names = [f for f in os.listdir(data_path) if re.fullmatch(pattern, f)][:MAX_OBJECTS + 1]
+    for position, f in enumerate(file_names):
+        upload_positions[f.replace('.json', '')] = position
+        saved_people[f.replace('.json', '')] = threading.Event()
+    if OMEKA_UPLOAD_WORKERS > 1:
+        http_transport.mount_pools(requests_session, 2 * OMEKA_UPLOAD_WORKERS)
+        with ThreadPoolExecutor(max_workers=OMEKA_UPLOAD_WORKERS) as media_executor:
+            with ThreadPoolExecutor(max_workers=OMEKA_UPLOAD_WORKERS) as executor:
+                media_futures = results_in_order([executor.submit(run_metrics.timed, 'entity upload', upload_entity, os.path.join(data_path, f), position, media_executor) for position, f in enumerate(file_names)])
+            results_in_order(media_futures)
+    else:
+        for position, f in enumerate(file_names):
+            with run_metrics.stage('entity upload'):
+                upload_entity(os.path.join(data_path, f), position)
+    save_item_index()
+    save_ledger()
+    if len(file_names) > MAX_OBJECTS:
+        exit(0)
     create_full_map_page()
 
 def add_properties_with_location_to_map(item):
@@ -438,7 +750,9 @@ def resize_image(img):
         rgb_im.save(img, format='JPEG')
 
 
-def upload_images(item_id, dt):
+def upload_images(item_id, dt, media_by_hash = None, kept_media = None):
+    media_by_hash = {} if media_by_hash is None else media_by_hash
+    kept_media = [] if kept_media is None else kept_media
     images = []
     ix = 0
     image_citations = dt.get('image_citations', [])
@@ -460,10 +774,18 @@ def upload_images(item_id, dt):
         if os.path.getsize(img) > 1.5 * 1024 * 1024:
             resize_image(img)
         citation = image_citations[ix] if len(image_citations) > ix else ''
-        images.append(upload_media_for_item(item_id, citation.replace("Image citation: ", ""), dt.get('name'), img)['o:id'])
+        citation = citation.replace("Image citation: ", "")
+        with open(img, 'rb') as image_file:
+            content_hash = media_content_hash(f'{dt.get("name")} - {citation}', image_file.read())
+        media = media_by_hash.pop(content_hash, None)
+        run_metrics.record_cache('media uploads', 'hit' if media else 'miss')
+        if not media:
+            media = upload_media_for_item(item_id, citation, dt.get('name'), img, content_hash)
+        kept_media.append(media)
+        images.append(media['o:id'])
         ix += 1
 
-        shutil.copyfile(img, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'images', f'{item_id}.jpg'))
+        shutil.copyfile(img, os.path.join(images_path, f'{item_id}.jpg'))
 
 
         if temp_image:
@@ -522,17 +844,17 @@ def get_bounding_box(latitude_in_degrees, longitude_in_degrees, half_side_in_mil
     return f'{rad2deg(lon_min)},{rad2deg(lat_min)},{rad2deg(lon_max)},{rad2deg(lat_max)}'
 
 def load_descriptions():
-    pattern = r'Q\d+?\.json'
+    pattern = r'Q\d+\.json'
     for f in os.listdir(data_path):
-        if re.match(pattern,f):
+        if re.fullmatch(pattern, f):
             with open(os.path.join(data_path, f)) as file:
                 student_json = json.load(file)
             description_by_label[student_json['label']] = student_json.get('description')
 
 def create_all_people():
-    pattern = r'Q\d+?\.json'
+    pattern = r'Q\d+\.json'
     for f in os.listdir(data_path):
-        if re.match(pattern,f):
+        if re.fullmatch(pattern, f):
             id = f.replace('.json', '')
             if not load_item_by_wikidata_id(id):
                 item = {
@@ -547,7 +869,9 @@ def create_all_people():
                     'o:item_set': [{'o:id': OMEKA_ITEM_SET}],
                 }
                 omeka_item = omeka_api_post('/items', {}, item)
+                index_item(id, omeka_item)
                 _logger.info(f'Created item {id} with o:id {omeka_item["o:id"]}')
+    save_item_index()
 
 remove_punctuation = str.maketrans('', '', string.punctuation)
 def sort_name(person):
@@ -610,17 +934,17 @@ def browse_page_html(site_data, omeka_site):
          <div class="row justify-content-center">
     '''
 
-    items = omeka_api_get(f'/items?item_set_id={OMEKA_ITEM_SET}&per_page=10000')
-    people = [p for p in items if 'schema:Person' in p['@type']]
+    people = [p for p in omeka_api_list('/items', {'item_set_id': OMEKA_ITEM_SET, 'sort_by': 'id', 'sort_order': 'asc'}) if 'schema:Person' in p['@type']]
 
     people = sorted(people, key=sort_name)
+    media_by_id = get_media([media['o:id'] for person in people for media in person['o:media']])
 
     for person in people:
         student = person['o:title']
         image_urls = []
         for media in person['o:media']:
-            media_data = omeka_api_get(f'/media/{media["o:id"]}')
-            if media_data['@type'] == 'o:Media':
+            media_data = media_by_id.get(media['o:id'])
+            if media_data and media_data['@type'] == 'o:Media':
                 try:
                     image_url = media_data['thumbnail_display_urls']['large']
                     image_urls.append(f'<img src="{image_url}" class="card-img-top card-image" alt="{student}">')
@@ -959,32 +1283,43 @@ def configure_logging(name):
     fh_info.setLevel(log_level)
     root_logger.addHandler(fh_info)
 
+def write_run_metrics():
+    if OMEKA_METRICS:
+        run_metrics.write_summary(OMEKA_METRICS)
+    if OMEKA_TRACE:
+        run_metrics.write_trace(OMEKA_TRACE)
+
 def main():
     configure_logging('omeka_upload.log')
 
     global data_path, OMEKA_ITEM_SET, OMEKA_SITE
-    data_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wikidata-site/public/data')
-
+    # the metrics are also written when load_data stops at MAX_OBJECTS or the run exits early
+    try:
+        data_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wikidata-site/public/data')
 
-    site = omeka_api_get(f'/sites?slug={OMEKA_SITE_SLUG}', {})
-    if not site:
-        print('Site not found, exiting')
-        exit(1)
-        site = create_site()
-    else:
-        site = site[0]
-    OMEKA_SITE = site['o:id']
-    item_set = omeka_api_get(f'/item_sets?property[0][property]=dcterms:title&property[0][text]={OMEKA_ITEMSET_TITLE}&property[0][type]=eq',{})
-    if not item_set:
-        print('Set not found, exiting')
-        exit(1)
-        item_set = create_set()
-    else:
-        item_set = item_set[0]
-    OMEKA_ITEM_SET = item_set['o:id']
-    print(f"Using Site ID: {OMEKA_SITE}, and Item Set ID: {OMEKA_ITEM_SET}")
-    load_data()
-    update_site()
+        site = omeka_api_get(f'/sites?slug={OMEKA_SITE_SLUG}', {})
+        if not site:
+            print('Site not found, exiting')
+            exit(1)
+            site = create_site()
+        else:
+            site = site[0]
+        OMEKA_SITE = site['o:id']
+        item_set = omeka_api_get(f'/item_sets?property[0][property]=dcterms:title&property[0][text]={OMEKA_ITEMSET_TITLE}&property[0][type]=eq',{})
+        if not item_set:
+            print('Set not found, exiting')
+            exit(1)
+            item_set = create_set()
+        else:
+            item_set = item_set[0]
+        OMEKA_ITEM_SET = item_set['o:id']
+        print(f"Using Site ID: {OMEKA_SITE}, and Item Set ID: {OMEKA_ITEM_SET}")
+        with run_metrics.stage('upload'):
+            load_data()
+        with run_metrics.stage('site pages'):
+            update_site()
+    finally:
+        write_run_metrics()
 
 
 if __name__ == '__main__':
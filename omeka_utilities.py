@@ -2,12 +2,12 @@ import os
 import re
 import json
 import markdown
-import requests
 import math
 import string
 import logging
 from PIL import Image
 from io import StringIO
+import http_transport
 
 OMEKA_KEY=os.environ.get('OMEKA_KEY')
 OMEKA_CRED=os.environ.get('OMEKA_CRED')
@@ -25,8 +25,7 @@ _logger = logging.getLogger(__name__)
 
 
 ua_headers = {'User-Agent': 'YaleLibraryDownloader/0.0 (https://library.yale.edu; library@yale.edu)'}
-requests_session = requests.Session()
-requests_session.headers.update(ua_headers)
+requests_session = http_transport.session(ua_headers)
 
 def omeka_api_get(uri, params = {}):
     params['key_identity'] = OMEKA_KEY
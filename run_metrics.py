@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+_logger = logging.getLogger(__name__)
+
+# stage timings, http and cache counters are always collected, trace events only when a trace file was requested
+trace_enabled = False
+
+started = time.perf_counter()
+metrics_lock = threading.Lock()
+stages = {}
+http_hosts = {}
+cache_outcomes = {}
+trace_events = []
+thread_names = {}
+thread_state = threading.local()
+
+latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+latency_labels = [f'<={b}s' for b in latency_buckets] + [f'>{latency_buckets[-1]}s']
+
+
+def trace_event(name, start, elapsed, category, args = None):
+    thread = threading.current_thread()
+    thread_names[thread.ident] = thread.name
+    event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round((start - started) * 1e6), 'dur': round(elapsed * 1e6), 'pid': os.getpid(), 'tid': thread.ident}
+    if args:
+        event['args'] = args
+    trace_events.append(event)
+
+@contextmanager
+def stage(name):
+    # time spent in nested stages is counted in the total of the outer stage but not in its self time
+    stack = thread_state.__dict__.setdefault('stack', [])
+    nested = [0.0]
+    stack.append(nested)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        with metrics_lock:
+            timing = stages.setdefault(name, {'count': 0, 'total': 0.0, 'self': 0.0})
+            timing['count'] += 1
+            timing['total'] += elapsed
+            timing['self'] += elapsed - nested[0]
+            if trace_enabled:
+                trace_event(name, start, elapsed, 'stage')
+
+def timed(name, function, *args, **kwargs):
+    # for work handed to an executor, the stage has to be entered on the worker thread
+    with stage(name):
+        return function(*args, **kwargs)
+
+def record_request(method, url, status, size, start, elapsed, throttled = 0):
+    host = urlparse(url).hostname
+    with metrics_lock:
+        metrics = http_hosts.setdefault(host, {'requests': 0, 'bytes': 0, 'seconds': 0.0, 'throttled_seconds': 0.0, 'statuses': {}, 'latency': [0] * len(latency_labels)})
+        metrics['requests'] += 1
+        metrics['bytes'] += size
+        metrics['seconds'] += elapsed
+        metrics['throttled_seconds'] += throttled
+        metrics['statuses'][str(status)] = metrics['statuses'].get(str(status), 0) + 1
+        metrics['latency'][bisect.bisect_left(latency_buckets, elapsed)] += 1
+        if trace_enabled:
+            trace_event(f'{method} {host}', start, elapsed, 'http', {'url': url, 'status': status, 'bytes': size})
+
+def record_cache(cache, outcome, count = 1):
+    # outcome is hit (used without a request), not_modified (revalidated) or miss (downloaded)
+    with metrics_lock:
+        outcomes = cache_outcomes.setdefault(cache, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + count
+
+
+def summary():
+    with metrics_lock:
+        http = {}
+        for host, metrics in http_hosts.items():
+            http[host] = {
+                'requests': metrics['requests'],
+                'bytes': metrics['bytes'],
+                'mean_latency': metrics['seconds'] / metrics['requests'],
+                'throttled_seconds': metrics['throttled_seconds'],
+                'statuses': dict(metrics['statuses']),
+                'not_modified_ratio': metrics['statuses'].get('304', 0) / metrics['requests'],
+                'latency': dict(zip(latency_labels, metrics['latency']))
+            }
+        caches = {}
+        for cache, outcomes in cache_outcomes.items():
+            lookups = sum(outcomes.values())
+            caches[cache] = dict(outcomes, lookups=lookups, **{f'{outcome}_ratio': count / lookups for outcome, count in outcomes.items()})
+        return {
+            'wall_time': time.perf_counter() - started,
+            'stages': {name: dict(timing) for name, timing in sorted(stages.items(), key=lambda s: -s[1]['total'])},
+            'http': http,
+            'caches': caches
+        }
+
+def write_summary(file_name):
+    with open(file_name, 'w') as f:
+        json.dump(summary(), f, indent=4)
+    _logger.info(f'Wrote run metrics to {file_name}')
+
+def write_trace(file_name):
+    # Chrome trace event format, open in chrome://tracing or https://ui.perfetto.dev
+    with metrics_lock:
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}} for tid, name in thread_names.items()]
+        events.extend(trace_events)
+    with open(file_name, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    _logger.info(f'Wrote {len(events)} trace events to {file_name}')
@@ -0,0 +1,170 @@
+import os
+import json
+import gzip
+import shutil
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_logger = logging.getLogger(__name__)
+
+compact_json = False
+
+compressed_extensions = ['.gz', '.br']
+compressible_extensions = ['.json']
+
+rendition_formats = {'jpg': 'JPEG', 'webp': 'WEBP'}
+
+# values that refer to another entity and carry its data
+ref_value_types = ['wikibase-item', 'wikibase-property', 'wikibase-form']
+
+
+def json_text(data):
+    if compact_json:
+        return json.dumps(data, separators=(',', ':'))
+    return json.dumps(data, indent=4)
+
+def write_json(file_name, data):
+    content = json_text(data)
+    with open(file_name, 'w') as f:
+        f.write(content)
+    return content
+
+
+def compress_file(file_name):
+    with open(file_name, 'rb') as f:
+        content = f.read()
+    # mtime=0 keeps the .gz files identical between runs
+    with open(f'{file_name}.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli:
+        with open(f'{file_name}.br', 'wb') as f:
+            f.write(brotli.compress(content, quality=11))
+    return file_name
+
+def needs_compression(file_name):
+    if not os.path.splitext(file_name)[1] in compressible_extensions:
+        return False
+    modified = os.path.getmtime(file_name)
+    extensions = compressed_extensions if brotli else ['.gz']
+    for extension in extensions:
+        compressed_file = f'{file_name}{extension}'
+        if not os.path.exists(compressed_file) or os.path.getmtime(compressed_file) < modified:
+            return True
+    return False
+
+def compress_directory(path, workers = None):
+    # write .gz and .br siblings for nginx gzip_static / brotli_static
+    if not brotli:
+        _logger.warning('brotli is not installed, only writing .gz files')
+    file_names = []
+    for directory, _, files in os.walk(path):
+        for f in files:
+            file_name = os.path.join(directory, f)
+            base_name, extension = os.path.splitext(file_name)
+            if extension in compressed_extensions:
+                if not os.path.exists(base_name):
+                    os.remove(file_name)
+            elif needs_compression(file_name):
+                file_names.append(file_name)
+    if not file_names:
+        return
+    _logger.info(f'Compressing {len(file_names)} files')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(compress_file, file_names, chunksize=16))
+
+
+def ref_shard(id, shards):
+    # 31 based string hash, refShard in the site computes the same
+    hash = 0
+    for c in id:
+        hash = (hash * 31 + ord(c)) & 0xffffffff
+    return hash % shards
+
+def write_refs(path, refs, shard_size):
+    # referenced entity data by id in refs/{shard}.json, so the site only fetches the shards an entity refers to
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    shards = max(1, -(-len(refs) // shard_size))
+    shard_refs = [{} for _ in range(shards)]
+    for id in sorted(refs.keys()):
+        shard_refs[ref_shard(id, shards)][id] = refs[id]
+    for shard, data in enumerate(shard_refs):
+        write_json(os.path.join(path, f'{shard}.json'), data)
+    write_json(os.path.join(path, 'meta.json'), {'version': 1, 'refs': len(refs), 'shards': shards})
+
+def read_refs(path):
+    # empty when the entities were written with inline refs
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_file):
+        return {}
+    with open(meta_file) as f:
+        shards = json.load(f)['shards']
+    refs = {}
+    for shard in range(shards):
+        with open(os.path.join(path, f'{shard}.json')) as f:
+            refs.update(json.load(f))
+    return refs
+
+def inline_refs(data, refs):
+    # puts the referenced entity data back into the values of an entity written with shared refs
+    if isinstance(data, dict):
+        if data.get('value-type') in ref_value_types and 'data' not in data and data.get('id') in refs:
+            data['data'] = refs[data['id']]
+        for value in data.values():
+            inline_refs(value, refs)
+    elif isinstance(data, list):
+        for value in data:
+            inline_refs(value, refs)
+    return data
+
+
+def rendition_size(width, height, max_size):
+    if max(width, height) <= max_size:
+        return width, height
+    scale = max_size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def render_image(job):
+    # renditions are kept next to the cached original and only redrawn when it changes
+    # returns None when the image could not be rendered, the other images are still rendered
+    source, cache_prefix, output_prefix, sizes = job
+    image = None
+    temp_file = None
+    try:
+        for name, max_size in sizes.items():
+            for extension, image_format in rendition_formats.items():
+                cached_file = f'{cache_prefix}.{name}.{extension}'
+                if not os.path.exists(cached_file) or os.path.getmtime(cached_file) < os.path.getmtime(source):
+                    if image is None:
+                        image = Image.open(source).convert('RGB')
+                    temp_file = f'{cached_file}.{os.getpid()}.tmp'
+                    image.resize(rendition_size(*image.size, max_size), Image.LANCZOS).save(temp_file, format=image_format, quality=85)
+                    os.replace(temp_file, cached_file)
+                    temp_file = None
+                shutil.copyfile(cached_file, f'{output_prefix}.{name}.{extension}')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        _logger.error(f'Unable to render {source}: {e}')
+        if temp_file and os.path.exists(temp_file):
+            os.remove(temp_file)
+        return None
+    finally:
+        if image:
+            image.close()
+    return source
+
+def write_image_renditions(jobs, workers = None):
+    # jobs are (source, cache_prefix, output_prefix, sizes)
+    if not jobs:
+        return
+    _logger.info(f'Writing renditions for {len(jobs)} images')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        failed = [job[0] for job, rendered in zip(jobs, executor.map(render_image, jobs, chunksize=4)) if not rendered]
+    if failed:
+        _logger.error(f'Unable to render {len(failed)} images, eg {failed[0]}')
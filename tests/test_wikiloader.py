@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import wikiloader
+
+
+@pytest.fixture
+def incremental_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(wikiloader, 'data_path', str(tmp_path))
+    monkeypatch.setattr(wikiloader, 'incremental', True)
+    monkeypatch.setattr(wikiloader, 'workers', 1)
+    monkeypatch.setattr(wikiloader, 'checkpoint_file', None)
+    monkeypatch.setattr(wikiloader, 'site_json', {'images': 'https://example.org/images/'})
+    monkeypatch.setattr(wikiloader, 'build_manifest', {})
+    monkeypatch.setattr(wikiloader, 'prefetch_entity_graph', lambda ids: None)
+    monkeypatch.setattr(wikiloader, 'refresh_image', lambda id: None)
+    monkeypatch.setattr(wikiloader, 'entity_dependencies', lambda wiki_entity: {})
+    monkeypatch.setattr(wikiloader, 'load_wikidata_entity', lambda id: {'id': id, 'modified': '2024-01-01T00:00:00Z', 'labels': {'en': {'value': f'Person {id}'}}})
+    for state in [wikiloader.search_index, wikiloader.entity_list, wikiloader.manifest_entities, wikiloader.content_hashes, wikiloader.entity_locations]:
+        state.clear()
+    yield tmp_path
+    for state in [wikiloader.search_index, wikiloader.entity_list, wikiloader.manifest_entities, wikiloader.content_hashes, wikiloader.entity_locations]:
+        state.clear()
+
+
+def test_incremental_skips_entity_that_fails_to_build(incremental_run, monkeypatch):
+    def load_claims(entity):
+        if entity['id'] == 'Q1':
+            raise ValueError('broken claims')
+        return {}
+    monkeypatch.setattr(wikiloader, 'load_claims', load_claims)
+
+    wikiloader.load_entities(['Q1', 'Q2'])
+
+    assert [entry['id'] for entry in wikiloader.search_index] == ['Q2']
+    assert list(wikiloader.entity_list) == ['Q2']
+    assert list(wikiloader.manifest_entities) == ['Q2']
+    assert not os.path.exists(os.path.join(incremental_run, 'Q1.json'))
+    assert os.path.exists(os.path.join(incremental_run, 'Q2.json'))
@@ -28,6 +28,40 @@ const normalize = (s) => {
   return s && s.replace(/[.,-/#!$%^&*;:{}=\-_`~()@+?"'><[\]+']/g, '').replace(/\s{2,}/g," ").toLowerCase();
 }
 
+const stopWords = new Set(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'it', 'of', 'on', 'or', 'that', 'the', 'to', 'was', 'were', 'with']);
+
+// must match search_tokens and search_shard_key in wikiloader.py
+const tokenize = (s) => (normalize(s) || '').split(/\s+/).filter(t => t && !stopWords.has(t));
+
+const shardKey = (term) => Array.from(term).slice(0, 2).map(c => /[a-z0-9]/.test(c) ? c : `_${c.codePointAt(0).toString(16)}`).join('');
+
+const loadShard = (index, key, basename) => {
+  if (!index.shards[key]) {
+    index.shards[key] = fetch(`${basename}/data/search/terms/${key}.json`).then(response => response.json());
+  }
+  return index.shards[key];
+}
+
+const invertedSearch = async (index, term, basename) => {
+  const tokens = tokenize(term);
+  const keys = [...new Set(tokens.map(shardKey))].filter(key => index.meta.shards.includes(key));
+  const shards = Object.fromEntries(await Promise.all(keys.map(async key => [key, await loadShard(index, key, basename)])));
+  const scores = {};
+  const addPostings = (postings, weight) => {
+    const idf = Math.log(1 + index.meta.documents / postings.length);
+    postings.forEach(([doc, count]) => scores[doc] = (scores[doc] || 0) + weight * count * idf);
+  }
+  tokens.forEach(token => {
+    const terms = shards[shardKey(token)] || {};
+    if (terms[token]) addPostings(terms[token], 1);
+    if (token.length > 2) {
+      // prefix matches stand in for stemming
+      Object.keys(terms).filter(t => t !== token && t.startsWith(token)).forEach(t => addPostings(terms[t], 0.5));
+    }
+  });
+  return Object.entries(scores).sort((a, b) => b[1] - a[1]).map(([doc]) => ({...index.docs[doc]}));
+}
+
 function ScrollToTop() {
   const { pathname } = useLocation();
 
@@ -63,12 +97,12 @@ function App() {
 
   useEffect(()=>{
     if (searchString && idx) {
-      setSearchResults(search(idx, searchString));
+      search(idx, searchString);
     }
   }, [searchString, idx]);
 
   useEffect(()=>{
-    fetch(`${basename}/data/search_index.json`)
+    const loadFullIndex = () => fetch(`${basename}/data/search_index.json`)
     .then(response => response.json())
     .then(data => {
       const idx = lunr(function () {
@@ -88,12 +122,19 @@ function App() {
     })
     .catch(error => {
       console.error(error);
-    })}
+    });
+    // prefer the sharded inverted index, only the shards a query needs are downloaded
+    fetch(`${basename}/data/search/meta.json`)
+    .then(response => response.json())
+    .then(meta => fetch(`${basename}/data/search/docs.json`)
+      .then(response => response.json())
+      .then(docs => setIdx({meta: meta, docs: docs, shards: {}})))
+    .catch(loadFullIndex)}
     , [basename]);
 
-  const search = (idx, term) => {
+  const search = async (idx, term) => {
     if (!idx) return;
-    let results = idx.search(normalize(term)).map((result)=>{return {...searchData[result['ref']]}});
+    let results = idx.meta ? await invertedSearch(idx, term, basename) : idx.search(normalize(term)).map((result)=>{return {...searchData[result['ref']]}});
     let unquoted = null;
     let terms = quotedText(term);
     if (terms.length) {
@@ -27,7 +27,7 @@ const EntityLink = ({id, description, label, properties, status}) => {
 
     return <div className={'card link-card' + ((status && ` status-${status}`) || '')} key={id}>
                 {status !== 'removed' && <Link to={link} className="stretched-link"></Link>}
-                {showImages(properties, 'wiki-image commons-image')}
+                {showImages(properties, 'wiki-image commons-image', undefined, 'card')}
                 <div className="card-body">
                     <h4 className="card-title">{label}</h4>
                     <p className="card-text">{description}</p>
@@ -5,9 +5,49 @@ const basename = document.querySelector('base')?.getAttribute('href') ?? '/';
 
 export const imagePath = (path) => path.startsWith('/') ? `${basename}${path}` : path;
 
-export const showImages = (properties, classNames, nfClassNames) => {
+// entities written with --refs shared keep only the id and label of the entities they refer to, the data is in data/refs/ sharded by id
+const refValueTypes = ['wikibase-item', 'wikibase-property', 'wikibase-form'];
+const refShards = {};
+let refsMeta = null;
+
+// same hash as site_output.ref_shard
+export const refShard = (id, shards) => {
+    let hash = 0;
+    for (let i = 0; i < id.length; i++) {
+        hash = (Math.imul(hash, 31) + id.charCodeAt(i)) >>> 0;
+    }
+    return hash % shards;
+}
+
+const sharedRefValues = (data, values = []) => {
+    if (Array.isArray(data)) {
+        data.forEach(item => sharedRefValues(item, values));
+    } else if (data && typeof data === 'object') {
+        if (refValueTypes.includes(data['value-type']) && data['id'] && !data['data']) values.push(data);
+        Object.values(data).forEach(item => sharedRefValues(item, values));
+    }
+    return values;
+}
+
+export const inlineRefs = (entity) => {
+    const values = sharedRefValues(entity.properties);
+    if (!values.length) return Promise.resolve(entity);
+    refsMeta = refsMeta || fetch(`${basename}/data/refs/meta.json`).then(response => response.json());
+    return refsMeta.then(meta => Promise.all(values.map(value => {
+        const shard = refShard(value['id'], meta.shards);
+        refShards[shard] = refShards[shard] || fetch(`${basename}/data/refs/${shard}.json`).then(response => response.json());
+        return refShards[shard].then(refs => {
+            if (refs[value['id']]) value['data'] = refs[value['id']];
+        });
+    }))).then(() => entity, error => {
+        console.error(error);
+        return entity;
+    });
+}
+
+export const showImages = (properties, classNames, nfClassNames, rendition) => {
     if (properties['image'] && properties['image']['values'] && properties['image']['values'].length > 0) {
-        return <CommonsMedia value={properties['image']['values'][0]} className={classNames}/>
+        return <CommonsMedia value={properties['image']['values'][0]} className={classNames} rendition={rendition}/>
     } else {
         return <img className={nfClassNames || 'wiki-image-nf'} src={imagePath('/assets/img-not-found.png')} alt='missing'/>
     }
@@ -1,9 +1,10 @@
 import React, { useEffect, useRef, useState } from 'react';
 import { Link, useParams } from 'react-router-dom';
 import { BoxArrowUpRight, GeoAltFill } from 'react-bootstrap-icons';
-import { formatWikiDateTime, imagePath, showImages } from './Utilities';
+import { formatWikiDateTime, imagePath, inlineRefs, showImages } from './Utilities';
 import Map from './components/Map';
 import CommonsMedia from './components/CommonsMedia';
+import GeoShape from './components/GeoShape';
 import Markdown from 'react-markdown'
 import remarkGfm from 'remark-gfm'
 import PropertyInfo from './components/PropertyInfo';
@@ -83,6 +84,7 @@ const PropertyValue = ({value, setHighlightedPlace, map}) => {
     if (value['value-type'] === 'globe-coordinate') return <GlobeCoordinate value={value} />
     if (value['value-type'] === 'string' || value['value-type'] === 'monolingualtext' || value['value-type'] === 'wikibase-form') return <>{value['text']}</>
     if (value['value-type'] === 'quantity') return <>{format_amount(value['amount'])}</>
+    if (value['value-type'] === 'geo-shape') return <GeoShape value={value} />
     return <div className='highlight'>{value['value-type']}</div>
 }
 
@@ -195,6 +197,7 @@ const WikidataEntity = () => {
     useEffect(() => {
         fetch(`${basename}/data/${id}.json`)
             .then(response => response.json())
+            .then(inlineRefs)
             .then(data => setEntityData(adjustData(data)))
             .catch(error => console.error(error));
     }, [id, basename]);
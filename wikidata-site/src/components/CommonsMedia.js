@@ -1,8 +1,14 @@
 import { imagePath } from "../Utilities";
 
-export const CommonsImage = ({imageInfo, className, video}) => {
+export const CommonsImage = ({imageInfo, className, video, rendition}) => {
     let mime = imageInfo['mime'];
-    if (mime.startsWith('image') && imageInfo['url']) {
+    const resized = rendition && imageInfo['renditions']?.[rendition];
+    if (resized) {
+        return <picture>
+                    <source srcSet={imagePath(resized['webp'])} type='image/webp'/>
+                    <img className={className} src={imagePath(resized['url'])} width={resized['width']} height={resized['height']} alt='CommonsImage'/>
+                </picture>
+    } else if (mime.startsWith('image') && imageInfo['url']) {
         return <img className={className} src={imagePath(imageInfo['url'])} alt='CommonsImage'/>
     } else if ((mime.startsWith('video') || mime.startsWith('application/ogg') || video) && imageInfo['url']) {
         return <video autoplay
@@ -20,9 +26,9 @@ export const CommonsImage = ({imageInfo, className, video}) => {
     }
 }
 
-export const CommonsMedia = ({value, className, video}) => {
+export const CommonsMedia = ({value, className, video, rendition}) => {
     if (value['image-info']) {
-        return value['image-info'].map((info, index) => <CommonsImage key={index} imageInfo={info} className={className} video={video}/>)
+        return value['image-info'].map((info, index) => <CommonsImage key={index} imageInfo={info} className={className} video={video} rendition={rendition}/>)
     }
 }
 
@@ -0,0 +1,54 @@
+import "leaflet/dist/leaflet.css";
+import L from "leaflet";
+import { useEffect, useRef } from 'react';
+
+const basename = document.querySelector('base')?.getAttribute('href') ?? '/';
+
+// shared geo-shapes are written once to data/geoshapes/ and only fetched when an entity shows them
+const sharedShapes = {};
+
+const loadShape = (value) => {
+    if (value['geo-shape']) return Promise.resolve(value['geo-shape']);
+    const id = value['geo-shape-id'];
+    if (!sharedShapes[id]) {
+        sharedShapes[id] = fetch(`${basename}/data/geoshapes/${id}.json`).then(response => response.json());
+    }
+    return sharedShapes[id];
+}
+
+// the Commons api response holds the .map page, its data is the GeoJSON
+const shapeGeoJson = (shape) => {
+    const page = Object.values(shape?.query?.pages || {})[0];
+    const content = page?.revisions?.[0]?.slots?.main?.['*'];
+    try {
+        return content && JSON.parse(content).data;
+    } catch (e) {
+        return null;
+    }
+}
+
+const GeoShape = ({value}) => {
+    const element = useRef(null);
+    useEffect(() => {
+        let map = null;
+        let cancelled = false;
+        loadShape(value).then(shape => {
+            const geoJson = shapeGeoJson(shape);
+            if (cancelled || !geoJson || !element.current) return;
+            map = L.map(element.current, {minZoom: 2});
+            L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+                maxZoom: 18,
+                attribution: '&copy; <a href="http://www.openstreetmap.org/copyright">OpenStreetMap</a>'
+            }).addTo(map);
+            const layer = L.geoJSON(geoJson).addTo(map);
+            map.fitBounds(layer.getBounds());
+        }).catch(e => console.error(e));
+        return () => {
+            cancelled = true;
+            if (map) map.remove();
+        }
+    }, [value]);
+    return <div><div>{value['name']}</div><div ref={element} className='map-view'></div></div>
+}
+
+export default GeoShape;
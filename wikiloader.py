@@ -2,20 +2,28 @@ import logging
 import argparse
 from termcolor import colored
 import json
-import requests
 import os
 import re
 from PIL import Image
 import shutil
-import dateparser
-import gzip
+from datetime import datetime
 import string
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 import markdown
+import entity_cache
+import site_output
+import http_transport
+import run_metrics
 
 _logger = logging.getLogger(__name__)
 
 sparql_endpoint = 'https://query.wikidata.org/sparql'
+wikidata_api = 'https://www.wikidata.org/w/api.php'
+commons_api = 'https://commons.wikimedia.org/w/api.php'
+entity_batch_size = 50
 
 data_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wikidata-site/public/data')
 
@@ -23,9 +31,59 @@ wiki_cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wik
 
 disable_cache_check = False
 use_image_cache = True
+image_renditions = False
+image_rendition_sizes = {'thumb': 160, 'card': 480}
+# (source, cache prefix, output prefix, sizes) for the process pool that writes the renditions
+image_jobs = []
+workers = 1
+
+# entities downloaded or validated during this run, they do not need another cache check
+fresh_ids = set()
+
+use_derived_cache = True
+derived_cache_version = 1
+derived_context = None
+dependency_recorder = threading.local()
+
+# geo-shapes loaded or validated during this run by title, inline in the entities or shared in geoshapes/
+geo_shapes = {}
+geo_shape_prefix = 'geo-shape:'
+geo_shape_output = 'inline'
+written_geo_shapes = set()
+
+# with --refs shared the data of referenced entities is written once to refs/ and their values keep only the id and label
+ref_output = 'inline'
+ref_shard_size = 100
+ref_data = {}
+# the referenced entity ids of every saved entity
+entity_refs = {}
+journaled_refs = set()
 
 search_index = []
 
+# entity refs by id, written to entity_list.json once at the end of the run
+entity_list = {}
+
+# incremental builds keep the inputs and outputs of every entity in build_manifest.json
+incremental = False
+manifest_version = 1
+build_manifest = {}
+manifest_entities = {}
+
+# per entity hashes of the comparable content, published as content_hashes.json so compare_with_site can skip unchanged entities
+content_hashes = {}
+compare_workers = 8
+
+# coordinates of the places each entity refers to, assembled into location_information.json at the end of the run
+entity_locations = {}
+
+# completed entities are journaled to checkpoint.jsonl so an interrupted run can be continued with --resume
+checkpoint_version = 1
+checkpoint_interval = 100
+checkpoint_file = None
+checkpoint_pending = []
+resumed_ids = set()
+
 site_json = {}
 
 if not os.path.exists(data_path):
@@ -33,10 +91,10 @@ if not os.path.exists(data_path):
 if not os.path.exists(wiki_cache_path):
     os.makedirs(wiki_cache_path)
 
+wiki_cache = entity_cache.file_entity_cache(wiki_cache_path)
 
 wiki_bot_headers = {'User-Agent': 'YaleLibraryDownloader/0.0 (https://library.yale.edu; library@yale.edu)'}
-requests_session = requests.Session()
-requests_session.headers.update(wiki_bot_headers)
+requests_session = http_transport.session(wiki_bot_headers)
 
 label_map = {}
 
@@ -54,42 +112,248 @@ def configure_logging(name):
     fh_info.setLevel(log_level)
     root_logger.addHandler(fh_info)
 
+def record_dependencies(dependencies):
+    # lookups in progress on this thread depend on the entity versions they read
+    for recorded in getattr(dependency_recorder, 'stack', []):
+        recorded.update(dependencies)
+
 def load_wikidata_entity(id):
-    cache_file = os.path.join(wiki_cache_path, f'{id}.json.gz')
-    existing_data = None
-    if os.path.exists(cache_file):
-        with gzip.open(cache_file, 'rt') as cf:
-            try:
-                existing_data = json.loads(cf.read())
-            except:
-                _logger.error(f'Unable to read cache for {id}')
-    if existing_data and disable_cache_check:
+    entity = fetch_wikidata_entity(id)
+    record_dependencies({id: [entity.get('modified') if entity else None, label_map.get(id)]})
+    return entity
+
+def fetch_wikidata_entity(id):
+    existing_data = wiki_cache.get(id)
+    if existing_data and (disable_cache_check or id in fresh_ids):
+        run_metrics.record_cache('wikidata entities', 'hit')
         return existing_data
     url = f'https://www.wikidata.org/wiki/Special:EntityData/{id}.json'
     headers = {}
     if existing_data:
         modifications = existing_data.get('modified')
-        dt = dateparser.parse(modifications)
+        dt = datetime.fromisoformat(modifications)
         headers['If-Modified-Since'] = dt.strftime('%a, %d %b %Y %H:%M:%S GMT')
-    response = requests_session.get(url, headers=headers)
+    with run_metrics.stage('entity fetch'):
+        response = requests_session.get(url, headers=headers)
     if response.status_code == 200:
+        run_metrics.record_cache('wikidata entities', 'miss')
         response_json = response.json()
         downloaded_data = response_json.get('entities', {}).get(id, None)
         if not downloaded_data:
             v = list(response_json.get('entities', {}).values())
             if len(v) > 0:
                 downloaded_data = v[0]
-        _logger.debug(f'adding to cache {id}')
         if downloaded_data:
-            with gzip.open(cache_file, 'wt') as cf:
-                cf.write(json.dumps(downloaded_data))
+            _logger.debug(f'adding to cache {id}')
+            wiki_cache.put(id, downloaded_data)
+            fresh_ids.add(id)
         return downloaded_data
     elif response.status_code == 304:
+        run_metrics.record_cache('wikidata entities', 'not_modified')
         _logger.debug(f'using cache {id}')
+        fresh_ids.add(id)
         return existing_data
     return None
 
 
+def prefetch_entities(ids):
+    pending = [id for id in dict.fromkeys(ids) if id and id not in fresh_ids]
+    if disable_cache_check:
+        cached_ids = wiki_cache.contains(pending)
+        pending = [id for id in pending if id not in cached_ids]
+        run_metrics.record_cache('wikidata entities', 'hit', len(cached_ids))
+    for ix in range(0, len(pending), entity_batch_size):
+        batch = pending[ix:ix + entity_batch_size]
+        _logger.debug(f'fetching {len(batch)} entities')
+        params = {'action': 'wbgetentities', 'ids': '|'.join(batch), 'format': 'json'}
+        with run_metrics.stage('entity fetch'):
+            response = requests_session.get(wikidata_api, params=params)
+        if response.status_code != 200:
+            _logger.error(f'Unable to fetch entities {response.status_code} {batch[0]}..{batch[-1]}')
+            continue
+        downloaded = {}
+        for id, data in response.json().get('entities', {}).items():
+            if 'missing' in data:
+                continue
+            # redirected ids are returned under the target id
+            downloaded[data.get('redirects', {}).get('from', id)] = data
+        wiki_cache.put_many(downloaded)
+        fresh_ids.update(downloaded.keys())
+        run_metrics.record_cache('wikidata entities', 'miss', len(downloaded))
+
+
+def revalidate_cached_entities(ids):
+    # compare cached revisions with the current lastrevid in batches and only download the changed entities
+    revisions = wiki_cache.revisions([id for id in ids if id not in fresh_ids])
+    pending = list(revisions.keys())
+    if not pending:
+        return
+    changed = []
+    for ix in range(0, len(pending), entity_batch_size):
+        batch = pending[ix:ix + entity_batch_size]
+        params = {'action': 'wbgetentities', 'ids': '|'.join(batch), 'props': 'info', 'format': 'json'}
+        with run_metrics.stage('entity revalidation'):
+            response = requests_session.get(wikidata_api, params=params)
+        if response.status_code != 200:
+            _logger.error(f'Unable to revalidate entities {response.status_code} {batch[0]}..{batch[-1]}')
+            continue
+        for id, info in response.json().get('entities', {}).items():
+            if 'missing' in info:
+                continue
+            id = info.get('redirects', {}).get('from', id)
+            if id in revisions and info.get('lastrevid') == revisions[id]:
+                fresh_ids.add(id)
+                run_metrics.record_cache('wikidata entities', 'not_modified')
+            else:
+                changed.append(id)
+    _logger.info(f'{len(pending)} cached entities checked, {len(changed)} changed')
+    prefetch_entities(changed)
+
+
+def fetch_geo_shape(name, lastrevid):
+    url = f'https://commons.wikimedia.org/w/api.php?action=query&prop=revisions&rvslots=*&rvprop=content&format=json&titles={name}'
+    with run_metrics.stage('geo-shape fetch'):
+        response = requests_session.get(url)
+    run_metrics.record_cache('geo-shapes', 'miss')
+    if response.status_code != 200:
+        _logger.error(f'Unable to fetch geo-shape {response.status_code} {name}')
+        return None
+    record = {'lastrevid': lastrevid, 'data': response.json()}
+    wiki_cache.put_shape(name, record)
+    return record
+
+def prefetch_geo_shapes(names):
+    # compare cached shapes with the current lastrevid of their Commons pages and only download the changed ones
+    pending = [name for name in dict.fromkeys(names) if name and name not in geo_shapes]
+    cached = {}
+    for name in pending:
+        record = wiki_cache.get_shape(name)
+        if record:
+            cached[name] = record
+    if disable_cache_check:
+        geo_shapes.update(cached)
+        pending = [name for name in pending if name not in cached]
+        run_metrics.record_cache('geo-shapes', 'hit', len(cached))
+    revisions = {}
+    for ix in range(0, len(pending), entity_batch_size):
+        batch = pending[ix:ix + entity_batch_size]
+        params = {'action': 'query', 'prop': 'info', 'titles': '|'.join(batch), 'format': 'json'}
+        with run_metrics.stage('geo-shape revalidation'):
+            response = requests_session.get(commons_api, params=params)
+        if response.status_code != 200:
+            _logger.error(f'Unable to revalidate geo-shapes {response.status_code} {batch[0]}..{batch[-1]}')
+            continue
+        query = response.json().get('query', {})
+        titles = {normalized['to']: normalized['from'] for normalized in query.get('normalized', [])}
+        for page in query.get('pages', {}).values():
+            revisions[titles.get(page.get('title'), page.get('title'))] = page.get('lastrevid')
+    for name in pending:
+        record = cached.get(name)
+        if not record or name not in revisions or record.get('lastrevid') != revisions[name]:
+            record = fetch_geo_shape(name, revisions.get(name))
+        else:
+            run_metrics.record_cache('geo-shapes', 'not_modified')
+        if record:
+            geo_shapes[name] = record
+
+def load_geo_shape(name):
+    prefetch_geo_shapes([name])
+    record = geo_shapes.get(name)
+    record_dependencies({f'{geo_shape_prefix}{name}': [record.get('lastrevid') if record else None, None]})
+    if record:
+        return record['data']
+
+def snack_geo_shapes(snack):
+    if snack.get('datatype') == 'geo-shape':
+        name = find(snack, 'datavalue.value')
+        if name:
+            return [name]
+    return []
+
+def claim_geo_shapes(entity, property_keys):
+    claims = entity.get('claims', {})
+    names = []
+    for key in [key for key in property_keys if key in claims]:
+        for value in claims[key]:
+            names.extend(snack_geo_shapes(value.get('mainsnak', {})))
+            for qualifiers in value.get('qualifiers', {}).values():
+                for qualifier in qualifiers:
+                    names.extend(snack_geo_shapes(qualifier))
+    return names
+
+def loaded_property_keys(entity):
+    property_keys = entity.get('claims', {}).keys()
+    if allowed_properties:
+        property_keys = [p for p in property_keys if p in allowed_properties]
+    return property_keys
+
+def snack_entity_ids(snack, include_forms = False):
+    ids = []
+    match snack.get('datatype'):
+        case 'wikibase-item' | 'wikibase-property':
+            ids.append(find(snack, 'datavalue.value.id'))
+        case 'wikibase-form' if include_forms:
+            ids.append(find(snack, 'datavalue.value.id'))
+        case 'quantity':
+            unit_ref = find(snack, 'datavalue.value.unit')
+            if unit_ref and unit_ref.startswith('http://www.wikidata.org/entity/'):
+                ids.append(unit_ref.replace('http://www.wikidata.org/entity/', ''))
+    return [id for id in ids if id]
+
+def claim_entity_ids(entity, include_forms = False):
+    claims = entity.get('claims', {})
+    ids = []
+    for key in loaded_property_keys(entity):
+        ids.append(key)
+        for value in claims[key]:
+            ids.extend(snack_entity_ids(value.get('mainsnak', {}), include_forms))
+            for qualifier_key, qualifiers in value.get('qualifiers', {}).items():
+                ids.append(qualifier_key)
+                for qualifier in qualifiers:
+                    ids.extend(snack_entity_ids(qualifier, include_forms))
+    return ids
+
+def first_claim_id(entity, property_id):
+    claims = entity.get('claims', {}).get(property_id)
+    if claims:
+        return find(claims[0], 'mainsnak.datavalue.value.id')
+
+def prefetch_entity_graph(ids):
+    # batch fetch the entities and the referenced entities that lookup_entity_data, load_state
+    # and enhanced_label_suffix will resolve for them, one level of the graph at a time
+    seen = set()
+    level = [(id, 'claims') for id in ids]
+    while level:
+        level = [(id, kind) for id, kind in dict.fromkeys(level) if id and (id, kind) not in seen]
+        seen.update(level)
+        # only the cached entities this run refers to are revalidated
+        if not disable_cache_check:
+            revalidate_cached_entities([id for id, _ in level])
+        prefetch_entities([id for id, _ in level])
+        entities = wiki_cache.get_many([id for id, _ in level])
+        next_level = []
+        shape_names = []
+        for id, kind in level:
+            entity = entities.get(id)
+            if not entity:
+                continue
+            match kind:
+                case 'claims':
+                    next_level.extend((ref, 'lookup') for ref in claim_entity_ids(entity) if ref not in entity_data)
+                    shape_names.extend(claim_geo_shapes(entity, loaded_property_keys(entity)))
+                case 'lookup':
+                    shape_names.extend(claim_geo_shapes(entity, value_properties))
+                    for instance_of in entity.get('claims', {}).get('P31', []):
+                        next_level.append((find(instance_of, 'mainsnak.datavalue.value.id'), 'label'))
+                    next_level.append((first_claim_id(entity, 'P131'), 'state'))
+                    next_level.append((first_claim_id(entity, 'P17'), 'label'))
+                    next_level.extend((key, 'lookup') for key in value_properties if key in entity.get('claims', {}) and key not in entity_data)
+                case 'state':
+                    next_level.append((first_claim_id(entity, 'P131'), 'state'))
+        prefetch_geo_shapes(shape_names)
+        level = next_level
+
+
 def lookup_entity_data(entity_id):
     entity = load_wikidata_entity(entity_id)
     data = {'label': label(entity)}
@@ -117,16 +381,71 @@ def lookup_entity_data(entity_id):
         _logger.error(f'No data for {entity_id}')
     return data
 
+def lookup_context():
+    # settings that change lookup_entity_data output without changing any entity
+    global derived_context
+    if not derived_context:
+        context = [derived_cache_version, value_properties, [entity_data[key] for key in value_properties],
+                   allowed_properties is None or [key in allowed_properties for key in value_properties]]
+        derived_context = hashlib.sha1(json.dumps(context).encode('utf-8')).hexdigest()
+    return derived_context
+
+def current_modified(id):
+    if id.startswith(geo_shape_prefix):
+        name = id[len(geo_shape_prefix):]
+        prefetch_geo_shapes([name])
+        return geo_shapes.get(name, {}).get('lastrevid')
+    if disable_cache_check or id in fresh_ids:
+        return wiki_cache.modified(id)
+    entity = load_wikidata_entity(id)
+    if entity:
+        return entity.get('modified')
+
+def dependencies_valid(dependencies):
+    for id, (modified, id_label) in dependencies.items():
+        if label_map.get(id) != id_label or current_modified(id) != modified:
+            return False
+    return True
+
+def derived_record_valid(record):
+    return record.get('context') == lookup_context() and dependencies_valid(record['dependencies'])
+
+def cached_lookup_entity_data(entity_id):
+    persist = use_derived_cache and entity_id not in value_properties
+    if persist:
+        record = wiki_cache.get_derived(entity_id)
+        if record and derived_record_valid(record):
+            run_metrics.record_cache('derived entity data', 'hit')
+            _logger.debug(f'using derived cache {entity_id}')
+            entity_data_dependencies[entity_id] = record['dependencies']
+            record_dependencies(record['dependencies'])
+            return record['data']
+    dependencies = {}
+    stack = dependency_recorder.__dict__.setdefault('stack', [])
+    stack.append(dependencies)
+    try:
+        data = lookup_entity_data(entity_id)
+    finally:
+        stack.pop()
+    entity_data_dependencies[entity_id] = dependencies
+    record_dependencies(dependencies)
+    if persist:
+        run_metrics.record_cache('derived entity data', 'miss')
+        wiki_cache.put_derived(entity_id, {'context': lookup_context(), 'dependencies': dependencies, 'data': data})
+    return data
+
 class properties_dict(dict):
     def __missing__(self, key):
         if 'http://www.wikidata.org/entity/' in key:
             _logger.error(colored(f'Key with wikidata URI: {key}', 'red'))
             key = key.replace('http://www.wikidata.org/entity/', '')
             return self[key]
-        self[key] = lookup_entity_data(key)
+        self[key] = cached_lookup_entity_data(key)
         return self[key]
 
 entity_data = properties_dict({})
+# the entity versions each entity_data lookup was derived from
+entity_data_dependencies = {}
 
 def snack_data(snack):
     value_data = None
@@ -168,9 +487,7 @@ def snack_data(snack):
                 #https://commons.wikimedia.org/w/api.php\?action\=query\&prop\=revisions\&rvslots\=\*\&rvprop\=content\&format\=json\&titles\=Data:South%20Korea/Seoul.map\&origin\=\*
                 data_value = find(snack, 'datavalue.value')
                 value_data['name'] = data_value
-                url = f'https://commons.wikimedia.org/w/api.php?action=query&prop=revisions&rvslots=*&rvprop=content&format=json&titles={data_value}'
-                resp = requests_session.get(url)
-                value_data['geo-shape'] = resp.json()
+                value_data['geo-shape'] = load_geo_shape(data_value)
             case 'quantity':
                 unit = None
                 unit_ref = find(snack, 'datavalue.value.unit')
@@ -317,17 +634,22 @@ def enhanced_label_suffix(entity):
         suffixes.append(country_label)
     return list(dict.fromkeys(suffixes))
 
-def add_to_entity_file(entity):
+def add_to_entity_list(entity):
     entity_ref = create_entity_ref(entity)
+    # a reloaded entity moves to the end of the list
+    entity_list.pop(entity_ref['id'], None)
+    entity_list[entity_ref['id']] = entity_ref
+
+def load_entity_list():
     entity_list_file = os.path.join(data_path, f'entity_list.json')
-    entity_list = []
     if os.path.exists(entity_list_file):
         with open(entity_list_file, 'r') as file:
-            entity_list = json.load(file)
-    entity_list = [entity for entity in entity_list if entity['id'] != entity_ref['id']]
-    entity_list.append(entity_ref)
-    with open(entity_list_file, 'w') as file:
-        file.write(json.dumps(entity_list, indent=4))
+            for entity_ref in json.load(file):
+                entity_list[entity_ref['id']] = entity_ref
+
+def write_entity_list():
+    entity_list_file = os.path.join(data_path, f'entity_list.json')
+    site_output.write_json(entity_list_file, list(entity_list.values()))
 
 def create_entity_ref(entity):
     entity_ref = {
@@ -348,12 +670,6 @@ def create_entity_ref(entity):
             entity_ref['properties'][ref_property] = prop
     return entity_ref
 
-def load_file_from_url(url):
-    response = requests_session.get(url)
-    if response.status_code == 200:
-        return response.text
-    return None
-
 def extract_columns(column_names, line):
     if not line:
         return None
@@ -367,27 +683,78 @@ def extract_columns(column_names, line):
         ix += 1
     return row
 
-def load_image(id):
+def image_cache_file(name):
+    return os.path.join(wiki_cache_path, 'images', name)
+
+def refresh_image(id):
+    # conditional download of the original image into the image cache
     url = f'{site_json["images"]}{id}.jpg'
-    image = f'{data_path}/{id}.jpg'
-    r = requests_session.get(url, stream=True)
-    if r.status_code == 200:
-        with open(image, 'wb') as f:
-            for chunk in r:
-                f.write(chunk)
-        return True
-    else:
+    cached_image = image_cache_file(f'{id}.jpg')
+    cached_validators = image_cache_file(f'{id}.jpg.json')
+    headers = {}
+    if use_image_cache and os.path.exists(cached_image) and os.path.exists(cached_validators):
+        with open(cached_validators) as f:
+            headers = conditional_headers(json.load(f))
+    # a streamed response keeps its pooled connection until it is closed, also on the 304 and error paths
+    with requests_session.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            run_metrics.record_cache('images', 'not_modified')
+            return cached_image
+        if r.status_code == 200:
+            run_metrics.record_cache('images', 'miss')
+            os.makedirs(os.path.dirname(cached_image), exist_ok=True)
+            temp_file = f'{cached_image}.{threading.get_ident()}.tmp'
+            with open(temp_file, 'wb') as f:
+                for chunk in r:
+                    f.write(chunk)
+            os.replace(temp_file, cached_image)
+            with open(cached_validators, 'w') as f:
+                json.dump(response_validators(r), f)
+            return cached_image
         _logger.error(f'Unable to load remote image {r.status_code} {url} {id}')
 
+def load_image(id):
+    cached_image = refresh_image(id)
+    if cached_image:
+        shutil.copyfile(cached_image, f'{data_path}/{id}.jpg')
+        return cached_image
+
+def queue_image_renditions(id, source):
+    cache_prefix = image_cache_file(id)
+    rendered = all(os.path.exists(f'{cache_prefix}.{name}.{extension}') and os.path.getmtime(f'{cache_prefix}.{name}.{extension}') >= os.path.getmtime(source)
+                   for name in image_rendition_sizes for extension in site_output.rendition_formats)
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+            if not rendered:
+                # a truncated or unsupported image fails here instead of in write_image_renditions
+                image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        _logger.error(f'Unable to read image {source} of {id}, skipping renditions: {e}')
+        return None
+    renditions = {}
+    for name, max_size in image_rendition_sizes.items():
+        rendition_width, rendition_height = site_output.rendition_size(width, height, max_size)
+        renditions[name] = {
+            'url': f'/data/{id}.{name}.jpg',
+            'webp': f'/data/{id}.{name}.webp',
+            'width': rendition_width,
+            'height': rendition_height
+        }
+    image_jobs.append((source, cache_prefix, os.path.join(data_path, id), image_rendition_sizes))
+    return {'width': width, 'height': height, 'renditions': renditions}
 
-def load(id, bio_url_prefix = None, property_override_url_prefix = None, publications_url_prefix = None):
+
+def build_entity(id, bio_url_prefix = None, property_override_url_prefix = None, publications_url_prefix = None, build_record = None):
     entity = {}
+    inputs = {}
     wiki_entity = load_wikidata_entity(id)
     _logger.info(colored(f'{id} - {wiki_entity["modified"]}', 'green'))
     entity['id'] = id
     entity['label'] = label(wiki_entity)
     if bio_url_prefix:
-        text = load_file_from_url(f'{bio_url_prefix}{id}.md')
+        with run_metrics.stage('markdown fetch'):
+            text = load_input_from_url(f'{bio_url_prefix}{id}.md', inputs, 'bio')
         if text:
             entity['biographyMarkdown'] = text
             lines = entity['biographyMarkdown'].split('\n')
@@ -397,20 +764,23 @@ def load(id, bio_url_prefix = None, property_override_url_prefix = None, publica
             else:
                 _logger.info(f'Description not found: {id}')
     if publications_url_prefix:
-        text = load_file_from_url(f'{publications_url_prefix}{id}.md')
+        with run_metrics.stage('markdown fetch'):
+            text = load_input_from_url(f'{publications_url_prefix}{id}.md', inputs, 'publications')
         if text:
             entity['publicationsMarkdown'] = text
 
     try:
-        entity['properties'] = load_claims(wiki_entity)
+        with run_metrics.stage('claims'):
+            entity['properties'] = load_claims(wiki_entity)
     except:
         _logger.error(f'Unable to load claims, skipping id {id}')
         return
     if property_override_url_prefix:
-        response = requests_session.get(f'{property_override_url_prefix}{id}.json')
-        if response.status_code == 200:
+        with run_metrics.stage('override fetch'):
+            text = load_input_from_url(f'{property_override_url_prefix}{id}.json', inputs, 'override')
+        if text is not None:
             try:
-                props = response.json()
+                props = json.loads(text)
                 entity['properties'].update(props)
                 rm_props = []
                 for k in entity['properties']:
@@ -420,28 +790,325 @@ def load(id, bio_url_prefix = None, property_override_url_prefix = None, publica
                     entity['properties'].pop(k, None)
             except Exception as e:
                 _logger.error(f'Error loading property overrides for {id} {e}')
-                print(response.text)
+                print(text)
                 print(e)
-    if load_image(id):
+    with run_metrics.stage('image'):
+        image_loaded = load_image(id)
+        inputs['image'] = file_hash(os.path.join(data_path, f'{id}.jpg')) if image_loaded else None
+        image_info = {
+            "url": f"/data/{id}.jpg",
+            "mime": "image/jpeg"
+        }
+        if image_loaded and image_renditions:
+            image_info.update(queue_image_renditions(id, image_loaded) or {})
+    if image_loaded:
         entity['properties']['image'] = {
             "label": "image",
             "values": [
                 {
                     "value-type": "commonsMedia",
                     "name": entity['label'],
-                    "image-info": [
-                        {
-                            "url": f"/data/{id}.jpg",
-                            "mime": "image/jpeg"
-                        }
-                    ]
+                    "image-info": [image_info]
                 }
             ]
         }
-    with open(os.path.join(data_path, f'{id}.json'), 'w') as file:
-        file.write(json.dumps(entity, indent=4))
-        search_index.append(entity_index_entry(id, entity))
-    add_to_entity_file(entity)
+    if build_record is not None:
+        build_record['inputs'] = inputs
+        build_record['dependencies'] = entity_dependencies(wiki_entity)
+    return entity
+
+
+def share_geo_shapes(data):
+    # copy of the entity data with each geo-shape written once to geoshapes/ and referenced by id
+    if isinstance(data, dict):
+        if data.get('value-type') == 'geo-shape' and data.get('geo-shape'):
+            shared = {k: v for k, v in data.items() if k != 'geo-shape'}
+            shared['geo-shape-id'] = write_geo_shape(data['name'], data['geo-shape'])
+            return shared
+        return {k: share_geo_shapes(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [share_geo_shapes(v) for v in data]
+    return data
+
+def write_geo_shape(name, shape):
+    shape_id = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+    if shape_id not in written_geo_shapes:
+        written_geo_shapes.add(shape_id)
+        geo_shape_path = os.path.join(data_path, 'geoshapes')
+        os.makedirs(geo_shape_path, exist_ok=True)
+        site_output.write_json(os.path.join(geo_shape_path, f'{shape_id}.json'), shape)
+    return shape_id
+
+def share_refs(data, refs):
+    # copy of the entity data with the data of referenced entities moved to refs
+    if isinstance(data, dict):
+        if data.get('value-type') in site_output.ref_value_types and 'data' in data and data.get('id'):
+            refs[data['id']] = data['data']
+            return {k: share_refs(v, refs) for k, v in data.items() if k != 'data'}
+        return {k: share_refs(v, refs) for k, v in data.items()}
+    if isinstance(data, list):
+        return [share_refs(v, refs) for v in data]
+    return data
+
+def value_ref_ids(data):
+    if isinstance(data, dict):
+        ids = [data['id']] if data.get('value-type') in site_output.ref_value_types and data.get('id') else []
+        for value in data.values():
+            ids.extend(value_ref_ids(value))
+        return ids
+    if isinstance(data, list):
+        return [id for value in data for id in value_ref_ids(value)]
+    return []
+
+def write_refs():
+    used = set()
+    for id in entity_list:
+        used.update(entity_refs.get(id, []))
+    missing = used.difference(ref_data)
+    if missing:
+        _logger.warning(f'No data for {len(missing)} referenced entities, eg {sorted(missing)[0]}')
+    site_output.write_refs(os.path.join(data_path, 'refs'), {id: ref_data[id] for id in used if id in ref_data}, ref_shard_size)
+
+def save_entity(entity, build_record = None):
+    id = entity['id']
+    # locations are taken from the entity before its referenced entity data is shared
+    locations = {'label': entity['label'], 'entries': entity_location_entries(entity)}
+    if geo_shape_output == 'shared':
+        entity = share_geo_shapes(entity)
+    if ref_output == 'shared':
+        refs = {}
+        entity = share_refs(entity, refs)
+        ref_data.update(refs)
+        entity_refs[id] = list(refs)
+    content = site_output.write_json(os.path.join(data_path, f'{id}.json'), entity)
+    search_index.append(entity_index_entry(id, entity))
+    content_hashes[id] = entity_content_hash(entity)
+    entity_locations[id] = locations
+    add_to_entity_list(entity)
+    if build_record is not None:
+        build_record['output'] = content_hash(content)
+        build_record['index'] = search_index[-1]
+        build_record['ref'] = entity_list[id]
+        build_record['content_hash'] = content_hashes[id]
+        build_record['locations'] = entity_locations[id]
+        if id in entity_refs:
+            build_record['refs'] = entity_refs[id]
+        manifest_entities[id] = build_record
+
+
+def content_hash(text):
+    if text is None:
+        return None
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def file_hash(file_name):
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def response_validators(response):
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+def conditional_headers(validators):
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def load_input_from_url(url, inputs, name):
+    # the content hash and validators of an input let the next incremental run revalidate it with a conditional request
+    response = requests_session.get(url)
+    text = response.text if response.status_code == 200 else None
+    inputs[name] = content_hash(text)
+    if text is not None:
+        inputs.setdefault('validators', {})[name] = response_validators(response)
+    return text
+
+def input_unchanged(url, inputs, name):
+    validators = inputs.get('validators', {}).get(name)
+    response = requests_session.get(url, headers=conditional_headers(validators) if validators else {})
+    if response.status_code == 304:
+        run_metrics.record_cache('entity inputs', 'not_modified')
+        return True
+    run_metrics.record_cache('entity inputs', 'miss')
+    text = response.text if response.status_code == 200 else None
+    if content_hash(text) != inputs.get(name):
+        return False
+    if text is not None:
+        # records written without validators or by a server that changed them are revalidated next time
+        inputs.setdefault('validators', {})[name] = response_validators(response)
+    return True
+
+def entity_dependencies(wiki_entity):
+    id = wiki_entity['id']
+    dependencies = {id: [wiki_entity.get('modified'), label_map.get(id)]}
+    for ref in claim_entity_ids(wiki_entity, True):
+        dependencies.update(entity_data_dependencies.get(ref, {}))
+    for name in claim_geo_shapes(wiki_entity, loaded_property_keys(wiki_entity)):
+        dependencies[f'{geo_shape_prefix}{name}'] = [geo_shapes.get(name, {}).get('lastrevid'), None]
+    return dependencies
+
+def build_context(bio_url_prefix, property_override_url_prefix, publications_url_prefix):
+    # settings that change the generated entities without changing any entity
+    context = [manifest_version, bio_url_prefix, property_override_url_prefix, publications_url_prefix, site_json.get('images'),
+               value_properties, allowed_properties, [dict.get(entity_data, key) for key in allowed_properties or []], geo_shape_output,
+               image_renditions and image_rendition_sizes]
+    if ref_output != 'inline':
+        context.append(ref_output)
+    return hashlib.sha1(json.dumps(context).encode('utf-8')).hexdigest()
+
+def entity_unchanged(id, record, context, bio_url_prefix, property_override_url_prefix, publications_url_prefix):
+    if not record or record.get('context') != context:
+        return False
+    if file_hash(os.path.join(data_path, f'{id}.json')) != record['output']:
+        return False
+    if not dependencies_valid(record['dependencies']):
+        return False
+    inputs = record['inputs']
+    if bio_url_prefix and not input_unchanged(f'{bio_url_prefix}{id}.md', inputs, 'bio'):
+        return False
+    if publications_url_prefix and not input_unchanged(f'{publications_url_prefix}{id}.md', inputs, 'publications'):
+        return False
+    if property_override_url_prefix and not input_unchanged(f'{property_override_url_prefix}{id}.json', inputs, 'override'):
+        return False
+    if inputs.get('image') and file_hash(os.path.join(data_path, f'{id}.jpg')) != inputs['image']:
+        return False
+    cached_image = refresh_image(id)
+    if (file_hash(cached_image) if cached_image else None) != inputs.get('image'):
+        return False
+    return True
+
+def reuse_entity(id, record):
+    search_index.append(record['index'])
+    entity_list.pop(id, None)
+    entity_list[id] = record['ref']
+    if record.get('content_hash'):
+        content_hashes[id] = record['content_hash']
+    if record.get('locations'):
+        entity_locations[id] = record['locations']
+    if record.get('refs') is not None:
+        entity_refs[id] = record['refs']
+    manifest_entities[id] = record
+
+def checkpoint_path():
+    return os.path.join(data_path, 'checkpoint.jsonl')
+
+def checkpoint_key(args, site_file):
+    # a checkpoint is only resumed by a run with the same inputs and output settings
+    settings = [checkpoint_version, args.entity_id, args.append, args.incremental, args.geo_shapes, args.image_renditions, args.refs]
+    settings.extend(file_hash(f) if f else None for f in [site_file, args.sparql_file, args.id_file])
+    return hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()
+
+def read_checkpoint(key):
+    # entities completed by an interrupted run, a partly written last line is dropped
+    if not os.path.exists(checkpoint_path()):
+        _logger.info(f'No checkpoint to resume in {data_path}, starting over')
+        return None
+    states = []
+    with open(checkpoint_path()) as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = {}
+        if header.get('key') != key:
+            _logger.warning(f'{checkpoint_path()} was written by a run with different settings, starting over')
+            return None
+        for line in f:
+            try:
+                states.append(json.loads(line))
+            except ValueError:
+                break
+    return states
+
+def open_checkpoint(key, states):
+    global checkpoint_file
+    temp_file = f'{checkpoint_path()}.tmp'
+    with open(temp_file, 'w') as f:
+        f.write(json.dumps({'key': key}) + '\n')
+        for state in states:
+            f.write(json.dumps(state) + '\n')
+    os.replace(temp_file, checkpoint_path())
+    checkpoint_file = open(checkpoint_path(), 'a')
+
+def restore_checkpoint(states):
+    for state in states:
+        id = state['id']
+        resumed_ids.add(id)
+        reuse_entity(id, state['record'])
+        if not incremental:
+            manifest_entities.pop(id, None)
+        if state.get('image_job'):
+            image_jobs.append(tuple(state['image_job']))
+        if state.get('ref_data'):
+            ref_data.update(state['ref_data'])
+            journaled_refs.update(state['ref_data'])
+    _logger.info(f'Resuming after {len(resumed_ids)} entities from {checkpoint_path()}')
+
+def checkpoint_entity(id):
+    if not checkpoint_file:
+        return
+    record = manifest_entities.get(id) or {'index': search_index[-1], 'ref': entity_list[id], 'content_hash': content_hashes.get(id),
+                                           'locations': entity_locations.get(id), 'refs': entity_refs.get(id)}
+    output_prefix = os.path.join(data_path, id)
+    image_job = next((job for job in reversed(image_jobs) if job[2] == output_prefix), None)
+    state = {'id': id, 'record': record, 'image_job': image_job}
+    # the data of each referenced entity is journaled with the first entity that refers to it
+    new_refs = [ref for ref in entity_refs.get(id, []) if ref not in journaled_refs and ref in ref_data]
+    if new_refs:
+        state['ref_data'] = {ref: ref_data[ref] for ref in new_refs}
+        journaled_refs.update(new_refs)
+    checkpoint_pending.append(state)
+    if len(checkpoint_pending) >= checkpoint_interval:
+        write_checkpoint()
+
+def write_checkpoint():
+    if not checkpoint_file or not checkpoint_pending:
+        return
+    with run_metrics.stage('checkpoint'):
+        checkpoint_file.write(''.join(json.dumps(state) + '\n' for state in checkpoint_pending))
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    checkpoint_pending.clear()
+
+def close_checkpoint():
+    # the run is complete, there is nothing left to resume
+    global checkpoint_file
+    if checkpoint_file:
+        checkpoint_file.close()
+        checkpoint_file = None
+    if os.path.exists(checkpoint_path()):
+        os.remove(checkpoint_path())
+
+def load_build_manifest():
+    global build_manifest
+    manifest_file = os.path.join(data_path, 'build_manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            build_manifest = json.load(f)
+        if build_manifest.get('version') != manifest_version:
+            build_manifest = {}
+
+def write_build_manifest():
+    with open(os.path.join(data_path, 'build_manifest.json'), 'w') as f:
+        json.dump({'version': manifest_version, 'entities': manifest_entities}, f)
+
+def remove_stale_entity_files():
+    for f in os.listdir(data_path):
+        if not f.startswith('Q'):
+            continue
+        record = manifest_entities.get(f.split('.')[0])
+        if not record or (f.endswith(('.jpg', '.webp')) and not record['inputs'].get('image')):
+            _logger.info(f'Removing {f}')
+            os.remove(os.path.join(data_path, f))
+
+
+def load(id, bio_url_prefix = None, property_override_url_prefix = None, publications_url_prefix = None):
+    entity = build_entity(id, bio_url_prefix, property_override_url_prefix, publications_url_prefix)
+    if entity:
+        save_entity(entity)
 
 
 def name_to_slug(name):
@@ -470,22 +1137,111 @@ def entity_index_entry(id, entity):
     entry['AllText'] = ' '.join(all_text)
     return entry
 
+search_fields = ['Label', 'Biography', 'Publications', 'AllText']
+search_stop_words = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'it', 'of', 'on', 'or', 'that', 'the', 'to', 'was', 'were', 'with'}
+search_punctuation = re.compile(r'[.,\-/#!$%^&*;:{}=_`~()@+?"\'><\[\]]')
+
+def search_tokens(text):
+    # same normalization as the site search
+    if isinstance(text, list):
+        text = ' '.join(t for t in text if t)
+    if not text:
+        return []
+    return [t for t in search_punctuation.sub('', text).lower().split() if t not in search_stop_words]
+
+def search_shard_key(term):
+    return ''.join(c if c in string.ascii_lowercase + string.digits else f'_{ord(c):x}' for c in term[:2])
+
+def write_inverted_search_index():
+    search_path = os.path.join(data_path, 'search')
+    if os.path.exists(search_path):
+        shutil.rmtree(search_path)
+    os.makedirs(os.path.join(search_path, 'terms'))
+    documents = []
+    postings = {}
+    for doc, entry in enumerate(search_index):
+        documents.append({k: v for k, v in entry.items() if k not in ('Biography', 'Publications', 'AllText')})
+        term_counts = {}
+        for field in search_fields:
+            for term in search_tokens(entry.get(field)):
+                term_counts[term] = term_counts.get(term, 0) + 1
+        for term, count in term_counts.items():
+            postings.setdefault(term, []).append([doc, count])
+    shards = {}
+    for term in sorted(postings.keys()):
+        shards.setdefault(search_shard_key(term), {})[term] = postings[term]
+    for key, terms in shards.items():
+        with open(os.path.join(search_path, 'terms', f'{key}.json'), 'w') as f:
+            json.dump(terms, f, separators=(',', ':'))
+    with open(os.path.join(search_path, 'docs.json'), 'w') as f:
+        json.dump(documents, f, separators=(',', ':'))
+    with open(os.path.join(search_path, 'meta.json'), 'w') as f:
+        json.dump({'version': 1, 'documents': len(documents), 'shards': sorted(shards.keys())}, f)
+
+def load_entities(ids, bio_url_prefix = None, property_override_url_prefix= None, publications_url_prefix = None, labels = None):
+    labels = labels or {}
+    if resumed_ids:
+        _logger.info(f'Skipping {len([id for id in ids if id in resumed_ids])} entities completed before resuming')
+        ids = [id for id in ids if id not in resumed_ids]
+    context = build_context(bio_url_prefix, property_override_url_prefix, publications_url_prefix) if incremental else None
+    with run_metrics.stage('prefetch'):
+        prefetch_entity_graph(ids)
+    def build(wikidata_id):
+        if incremental:
+            record = build_manifest.get('entities', {}).get(wikidata_id)
+            if entity_unchanged(wikidata_id, record, context, bio_url_prefix, property_override_url_prefix, publications_url_prefix):
+                _logger.info(colored(f'Unchanged {wikidata_id}', 'blue'))
+                return wikidata_id, None, record
+        if labels.get(wikidata_id):
+            _logger.info(colored(f'Loading {wikidata_id}: {labels[wikidata_id]}', 'blue'))
+        else:
+            _logger.info(colored(f'Loading {wikidata_id}', 'blue'))
+        record = {'context': context} if incremental else None
+        with run_metrics.stage('build'):
+            entity = build_entity(wikidata_id, bio_url_prefix, property_override_url_prefix, publications_url_prefix, record)
+        # an entity that failed to build is skipped, only records of unchanged entities are reused
+        return wikidata_id, entity, record if entity else None
+    def save(wikidata_id, entity, record):
+        with run_metrics.stage('write'):
+            if entity:
+                save_entity(entity, record)
+            elif record:
+                reuse_entity(wikidata_id, record)
+            else:
+                return
+        checkpoint_entity(wikidata_id)
+    try:
+        if workers > 1:
+            # entities are fetched concurrently but saved in the original order so the output matches a serial run
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for result in executor.map(build, ids):
+                    save(*result)
+        else:
+            for wikidata_id in ids:
+                save(*build(wikidata_id))
+    finally:
+        write_checkpoint()
+
 def load_ids(ids, bio_url_prefix = None, property_override_url_prefix= None, publications_url_prefix = None):
-    for wikidata_id in ids:
-        _logger.info(colored(f'Loading {wikidata_id}', 'blue'))
-        load(wikidata_id, bio_url_prefix, property_override_url_prefix, publications_url_prefix)
+    load_entities(ids, bio_url_prefix, property_override_url_prefix, publications_url_prefix)
 
-def load_sparql_results(sparql, bio_url_prefix = None, property_override_url_prefix= None, publications_url_prefix = None):
+def sparql_ids(sparql):
     params = {'query': sparql.replace('[AUTO_LANGUAGE]', 'en')}
     response = requests_session.get(sparql_endpoint, params=params, headers={'Accept':'application/json'})
     results = find(response.json(), 'results.bindings')
+    ids = []
+    labels = {}
     for result in results:
         wikidata_uri = find(result, 'item.value')
         if wikidata_uri:
-            label = find(result, 'itemLabel.value')
             wikidata_id = wikidata_uri.split('/')[-1:][0]
-            _logger.info(colored(f'Loading {wikidata_id}: {label}', 'blue'))
-            load(wikidata_id, bio_url_prefix, property_override_url_prefix, publications_url_prefix)
+            ids.append(wikidata_id)
+            labels[wikidata_id] = find(result, 'itemLabel.value')
+    return ids, labels
+
+def load_sparql_results(sparql, bio_url_prefix = None, property_override_url_prefix= None, publications_url_prefix = None):
+    ids, labels = sparql_ids(sparql)
+    load_entities(ids, bio_url_prefix, property_override_url_prefix, publications_url_prefix, labels)
 
 def load_id_list(id_list_url):
     id_list = []
@@ -505,6 +1261,44 @@ def load_id_list(id_list_url):
                     label_map[row[0]] = row[1]
     return id_list
 
+def comparable_entity(entity):
+    # the entity without the statuses added by compare_with_site
+    comparable = {k: v for k, v in entity.items() if k != 'status' and not k.endswith('Status')}
+    if entity.get('publicationsStatus') == 'removed':
+        comparable.pop('publications', None)
+    comparable['properties'] = {
+        label: {k: v for k, v in item.items() if k != 'status'}
+        for label, item in entity.get('properties', {}).items() if item.get('status') != 'removed'
+    }
+    return comparable
+
+def entity_content_hash(entity):
+    return content_hash(json.dumps(comparable_entity(entity), sort_keys=True, separators=(',', ':')))
+
+def load_kept_entities():
+    # entities kept from an earlier run by --append are read once for the content hashes, refs and locations
+    for id in entity_list:
+        needs_refs = ref_output == 'shared' and id not in entity_refs
+        if id in content_hashes and id in entity_locations and not needs_refs:
+            continue
+        entity_file = os.path.join(data_path, f'{id}.json')
+        if not os.path.exists(entity_file):
+            continue
+        with open(entity_file) as f:
+            entity = json.load(f)
+        if needs_refs:
+            entity_refs[id] = value_ref_ids(entity)
+        if id not in content_hashes:
+            content_hashes[id] = entity_content_hash(entity)
+        if id not in entity_locations:
+            entity = site_output.inline_refs(entity, ref_data)
+            entity_locations[id] = {'label': entity['label'], 'entries': entity_location_entries(entity)}
+
+def write_content_hashes():
+    hashes = {id: content_hashes[id] for id in entity_list if id in content_hashes}
+    with open(os.path.join(data_path, 'content_hashes.json'), 'w') as f:
+        json.dump(hashes, f, separators=(',', ':'))
+
 def get_response_json(response):
     if response.status_code == 200:
         try:
@@ -513,48 +1307,71 @@ def get_response_json(response):
             pass
     return None
 
+def entity_location_entries(entity):
+    entries = []
+    for item in entity['properties'].values():
+        property_id = item['label']
+        property_name = find(item, 'label')
+        for value in [i for i in item['values'] if i.get('value-type') == 'wikibase-item']:
+            for value_coordinate_property in value.get('data', {}).get('properties', {}).get('coordinate location', {}).get('values', []):
+                latitude = value_coordinate_property.get('latitude')
+                longitude = value_coordinate_property.get('longitude')
+                if latitude and longitude:
+                    entries.append({
+                        'id': value['id'],
+                        'label': value['text'],
+                        'lat': latitude,
+                        'long': longitude,
+                        'property_id': property_id,
+                        'property_name': property_name.title()
+                    })
+                    break
+    return entries
+
 def extract_location_information():
     location_information = {}
-    for f in os.listdir(data_path):
-        if (f.startswith('Q') and f.endswith('.json')):
-            with open(os.path.join(data_path, f)) as local_file:
-                local_json = json.load(local_file)
-            entity_id = local_json['id']
-            entity_name = local_json['label']
-            for item in local_json['properties'].values():
-                property_id = item['label']
-                property_name = find(item, 'label')
-                for value in [i for i in item['values'] if i.get('value-type') == 'wikibase-item']:
-                    value_id = value['id']
-                    value_name = value['text']
-                    for value_coordinate_property in value.get('data', {}).get('properties', {}).get('coordinate location', {}).get('values', []):
-                        latitude = value_coordinate_property.get('latitude')
-                        longitude = value_coordinate_property.get('longitude')
-                        if latitude and longitude:
-                            location = location_information.get(value_id, {'label': value_name, 'entity_properties': [], 'lat': latitude, 'long': longitude})
-                            location_information[value_id] = location
-                            entity_properties = location['entity_properties']
-                            info = {
-                                'property_id': property_id,
-                                'property_name': property_name.title(),
-                                'entity_id': entity_id,
-                                'entity_name': entity_name
-                            }
-                            entity_properties.append(info)
-                            break
-    with open(os.path.join(data_path, 'location_information.json'), 'w') as location_file:
-        location_file.write(json.dumps(location_information, indent=4))
+    for entity_id in entity_list:
+        if entity_id not in entity_locations:
+            continue
+        entity_name = entity_locations[entity_id]['label']
+        for entry in entity_locations[entity_id]['entries']:
+            location = location_information.get(entry['id'], {'label': entry['label'], 'entity_properties': [], 'lat': entry['lat'], 'long': entry['long']})
+            location_information[entry['id']] = location
+            location['entity_properties'].append({
+                'property_id': entry['property_id'],
+                'property_name': entry['property_name'],
+                'entity_id': entity_id,
+                'entity_name': entity_name
+            })
+    site_output.write_json(os.path.join(data_path, 'location_information.json'), location_information)
+
+def fetch_remote_entity(site, f):
+    return get_response_json(requests_session.get(f'{site}/data/{f}'))
 
 def compare_with_site(site):
     changed_ids = []
-    for f in os.listdir(data_path):
+    remote_hashes = get_response_json(requests_session.get(f'{site}/data/content_hashes.json')) or {}
+    compare_files = []
+    for f in sorted(os.listdir(data_path)):
         if (f.startswith('Q') and f.endswith('.json')):
+            id = f[:-len('.json')]
+            if id in remote_hashes:
+                local_hash = content_hashes.get(id)
+                if not local_hash:
+                    with open(os.path.join(data_path, f)) as local_file:
+                        local_hash = entity_content_hash(json.load(local_file))
+                if remote_hashes[id] == local_hash:
+                    _logger.info(f'No update for {f}')
+                    continue
+            compare_files.append(f)
+    _logger.info(f'Comparing {len(compare_files)} entities with {site}')
+
+    with ThreadPoolExecutor(max_workers=compare_workers) as executor:
+        remote_entities = executor.map(lambda f: fetch_remote_entity(site, f), compare_files)
+        for f, remote_json in zip(compare_files, remote_entities):
             with open(os.path.join(data_path, f)) as local_file:
                 local_json = json.load(local_file)
-            remote_json = None
             item_changed = False
-            response = requests_session.get(f'{site}/data/{f}')
-            remote_json = get_response_json(response)
             if remote_json:
                 for item in local_json['properties'].values():
                     remote_item = remote_json['properties'].get(item['label'])
@@ -602,8 +1419,7 @@ def compare_with_site(site):
             if item_changed:
                 _logger.info(f'Updating {f}')
                 changed_ids.append(local_json['id'])
-                with open(os.path.join(data_path, f), 'w') as local_file:
-                    local_file.write(json.dumps(local_json, indent=4))
+                site_output.write_json(os.path.join(data_path, f), local_json)
             else:
                 _logger.info(f'No update for {f}')
 
@@ -631,29 +1447,166 @@ def compare_with_site(site):
             local_json.append(item)
 
 
-    with open(os.path.join(data_path, f), 'w') as local_file:
-        local_file.write(json.dumps(local_json, indent=4))
+    site_output.write_json(os.path.join(data_path, f), local_json)
 
 def load_properties_list(file):
-    global allowed_properties
+    # (id, label) rows of a site properties file, None when it can not be loaded
     response = requests_session.get(file)
-    if response.status_code == 200:
-        data = response.text
+    if response.status_code != 200:
+        return None
+    properties = []
+    for line in response.text.split('\n'):
+        row = line.split(None, 1)
+        if len(row) < 2:
+            _logger.info(f'skipping row [{line}]')
+            continue
+        if row[0].startswith('P'):
+            properties.append((row[0], row[1]))
+    properties.append(('P625', 'coordinate location'))
+    return properties
+
+def use_properties(properties):
+    global allowed_properties, derived_context
+    derived_context = None
+    if properties is not None:
         allowed_properties = []
-        for line in data.split('\n'):
-            row = line.split(None, 1)
-            if len(row) < 2:
-                _logger.info(f'skipping row [{line}]')
-                continue
-            if row[0].startswith('P'):
-                entity_data[row[0]] = {'label': row[1]}
-                allowed_properties.append(row[0])
-        entity_data['P625'] = {'label': 'coordinate location'}
-        allowed_properties.append('P625')
+        for id, property_label in properties:
+            entity_data[id] = {'label': property_label}
+            allowed_properties.append(id)
+
+
+def site_file_entry(entry):
+    # FILE or FILE=DATA_PATH, by default a site is written to a directory named after its site file in the data path
+    site_file, _, site_data_path = entry.partition('=')
+    return site_file, site_data_path or os.path.join(data_path, os.path.splitext(os.path.basename(site_file))[0])
+
+def site_plan(site_file, site_data_path):
+    # the ids, id list labels and properties of a site, resolved before any site is built
+    with open(site_file) as f:
+        site = json.load(f)
+    _logger.info(f'Processing {site["title"]} from {site_file}.')
+    label_map.clear()
+    ids = []
+    labels = {}
+    if site.get('idList'):
+        id_list = site['idList']
+        if isinstance(id_list, str):
+            id_list = load_id_list(id_list)
+        ids.extend(id_list)
+    if site.get('sparql'):
+        sparql_result_ids, labels = sparql_ids(site['sparql'])
+        ids.extend(sparql_result_ids)
+    properties = load_properties_list(site['properties']) if site.get('properties') else None
+    return {'file': site_file, 'data_path': site_data_path, 'site': site, 'ids': ids, 'labels': labels, 'label_map': dict(label_map), 'properties': properties}
+
+def prefetch_sites(plans):
+    # one walk of the entity graph of all the sites with the union of their properties, so the entities they share are fetched once
+    global allowed_properties
+    site_properties = [plan['properties'] for plan in plans]
+    if all(site_properties):
+        allowed_properties = list(dict.fromkeys(id for properties in site_properties for id, _ in properties))
+    for properties in site_properties:
+        for id, property_label in properties or []:
+            entity_data[id] = {'label': property_label}
+    with run_metrics.stage('prefetch'):
+        prefetch_entity_graph(list(dict.fromkeys(id for plan in plans for id in plan['ids'])))
+
+def reset_site_state(plan):
+    # clears everything written for the previous site, the entity cache, fetched entities and geo-shapes are shared
+    global data_path, site_json, allowed_properties, derived_context, build_manifest
+    for state in [search_index, entity_list, content_hashes, entity_locations, manifest_entities, image_jobs, written_geo_shapes,
+                  checkpoint_pending, resumed_ids, entity_data, entity_data_dependencies, label_map, ref_data, entity_refs, journaled_refs]:
+        state.clear()
+    site_json = {}
+    allowed_properties = None
+    derived_context = None
+    build_manifest = {}
+    if plan:
+        data_path = plan['data_path']
+        os.makedirs(data_path, exist_ok=True)
+        label_map.update(plan['label_map'])
+
+def build_site(args, plan = None):
+    global site_json
+    reset_site_state(plan)
+    key = checkpoint_key(args, plan['file'] if plan else None)
+    resumed_states = read_checkpoint(key) if args.resume else None
+    if incremental:
+        load_build_manifest()
+    elif not args.append and resumed_states is None:
+        for f in os.listdir(data_path):
+            if f.startswith('Q') or f.endswith('.jpg') or f == f'entity_list.json':
+                os.remove(os.path.join(data_path, f))
+        shutil.rmtree(os.path.join(data_path, 'geoshapes'), ignore_errors=True)
+        shutil.rmtree(os.path.join(data_path, 'search'), ignore_errors=True)
+    elif args.append:
+        load_entity_list()
+    if ref_output == 'shared' and (incremental or args.append):
+        # entities kept from the earlier run refer to its refs
+        ref_data.update(site_output.read_refs(os.path.join(data_path, 'refs')))
+    if resumed_states:
+        restore_checkpoint(resumed_states)
+    if checkpoint_interval:
+        open_checkpoint(key, resumed_states or [])
+
+    if plan:
+        site_json = plan['site']
+        if site_json.get('properties'):
+            use_properties(plan['properties'])
+            _logger.info(f'allowed properties update with {allowed_properties}')
+        load_entities(plan['ids'], site_json.get('bioUrlPrefix'), site_json.get('propertyOverrideUrlPrefix'), site_json.get('publicationsUrlPrefix'), plan['labels'])
+        shutil.copyfile(plan['file'], os.path.join(data_path, 'site.json'))
+    elif args.entity_id:
+        load(args.entity_id)
+    elif args.id_file:
+        pattern = re.compile("^Q([0-9]+)$")
+        with open(args.id_file, 'r') as file:
+            ids = [line.strip() for line in file.readlines() if pattern.match(line.strip())]
+        load_ids(ids)
+    else:
+        with open(args.sparql_file, 'r') as file:
+            sparql = file.read()
+        load_sparql_results(sparql)
+
+    with run_metrics.stage('image renditions'):
+        site_output.write_image_renditions(image_jobs, workers if workers > 1 else None)
+    if incremental:
+        remove_stale_entity_files()
+        write_build_manifest()
+    with run_metrics.stage('entity list'):
+        write_entity_list()
+        load_kept_entities()
+        write_content_hashes()
+    with run_metrics.stage('refs'):
+        if ref_output == 'shared':
+            write_refs()
+        else:
+            shutil.rmtree(os.path.join(data_path, 'refs'), ignore_errors=True)
+    with run_metrics.stage('location extraction'):
+        extract_location_information()
+    with run_metrics.stage('search index'):
+        if args.search_index == 'inverted':
+            write_inverted_search_index()
+            if os.path.exists(os.path.join(data_path, 'search_index.json')):
+                os.remove(os.path.join(data_path, 'search_index.json'))
+        else:
+            # the site prefers search/ when it exists
+            shutil.rmtree(os.path.join(data_path, 'search'), ignore_errors=True)
+            with open(os.path.join(data_path, 'search_index.json'), 'w') as f:
+                json.dump(search_index, f)
+    close_checkpoint()
+
+    if args.compare_site:
+        with run_metrics.stage('compare'):
+            compare_with_site(args.compare_site)
+
+    if args.precompress:
+        with run_metrics.stage('compress'):
+            site_output.compress_directory(data_path, workers if workers > 1 else None)
 
 
 def main():
-    global allowed_properties, disable_cache_check, use_image_cache, data_path, wiki_cache_path, site_json
+    global disable_cache_check, use_image_cache, data_path, wiki_cache_path, workers, compare_workers, wiki_cache, use_derived_cache, incremental, geo_shape_output, ref_output, image_renditions, checkpoint_interval
     configure_logging('wikiloader.log')
     parser = argparse.ArgumentParser(description='Load wikidata')
     group = parser.add_mutually_exclusive_group(required=True)
@@ -661,68 +1614,80 @@ def main():
     group.add_argument('--sparql-file', required=False, help='SPARQL query file to get list of ids')
     group.add_argument('--site-file', required=False, help='JSON file containing query and or SPARQL with site information')
     group.add_argument('--id-file', required=False, help='File with a list of entity ids')
-    parser.add_argument('--append', action='store_true', help='Append to existing entities')
+    group.add_argument('--site-files', nargs='+', metavar='FILE[=DATA_PATH]', help='Build several sites in one run, fetching the entities they share once. Each site is written to DATA_PATH or to a directory named after its site file in the data path')
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument('--append', action='store_true', help='Append to existing entities')
+    mode_group.add_argument('--incremental', action='store_true', help='Only rebuild entities whose inputs changed since the last build')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run from its checkpoint instead of starting over')
+    parser.add_argument('--checkpoint-every', type=int, default=checkpoint_interval, help=f'Checkpoint after this many completed entities, 0 disables checkpoints (default {checkpoint_interval})')
     parser.add_argument('--no-cache-check', action='store_true', help='Disable cache check (always use the cached data)')
     parser.add_argument('--disable-image-cache', action='store_true', help='Disable image cache')
+    parser.add_argument('--image-renditions', action='store_true', help='Write thumbnail and card renditions (JPEG and WebP) of the entity images')
     parser.add_argument('--compare-site', required=False, help='Site for comparing values')
     parser.add_argument('--data-path', required=False, help=f'Path to react site data (default {data_path})')
     parser.add_argument('--cache-path', required=False, help=f'Path to wikidata cache (default {wiki_cache_path})')
+    parser.add_argument('--cache-backend', choices=entity_cache.cache_backends.keys(), default='files', help='Wikidata cache storage: one .json.gz file per entity or a single sqlite file (default files)')
+    parser.add_argument('--no-derived-cache', action='store_true', help='Recompute referenced entity data instead of reusing it from the cache')
+    parser.add_argument('--refs', choices=['inline', 'shared'], default=ref_output, help=f'Embed the data of referenced entities in every value or write it once to refs/ (default {ref_output})')
+    parser.add_argument('--geo-shapes', choices=['inline', 'shared'], default=geo_shape_output, help=f'Embed geo-shapes in every entity or write each one once to geoshapes/ (default {geo_shape_output})')
+    parser.add_argument('--search-index', choices=['full', 'inverted'], default='full', help='Write search_index.json with the full text or a sharded inverted index in search/ (default full)')
+    parser.add_argument('--compact', action='store_true', help='Write JSON without indentation')
+    parser.add_argument('--precompress', action='store_true', help='Write .gz and .br copies of the JSON files for gzip_static / brotli_static')
+    parser.add_argument('--workers', type=int, default=1, help='Number of entities to fetch concurrently (default 1)')
+    parser.add_argument('--compare-workers', type=int, default=compare_workers, help=f'Number of entities to fetch concurrently from the compare site (default {compare_workers})')
+    parser.add_argument('--max-retries', type=int, default=http_transport.max_retries, help=f'Number of times a request is retried after a 429, 5xx or connection error (default {http_transport.max_retries})')
+    parser.add_argument('--connect-timeout', type=float, default=http_transport.connect_timeout, help=f'Seconds to wait for a connection before the request is retried (default {http_transport.connect_timeout:g})')
+    parser.add_argument('--read-timeout', type=float, default=http_transport.read_timeout, help=f'Seconds to wait for data from the server before the request is retried (default {http_transport.read_timeout:g})')
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='HOST=RATE[/BURST]', help='Requests per second allowed to a host, can be repeated (eg www.wikidata.org=5/10)')
+    parser.add_argument('--metrics', required=False, help='Write stage timings, HTTP and cache statistics of the run to this JSON file')
+    parser.add_argument('--trace', required=False, help='Write a Chrome trace (chrome://tracing, ui.perfetto.dev) of the run to this file')
     args = parser.parse_args()
+    if args.site_files and args.compare_site:
+        parser.error('--compare-site compares a single site, it can not be used with --site-files')
+    run_metrics.trace_enabled = bool(args.trace)
 
     if args.data_path:
         data_path = args.data_path
     if args.cache_path:
         wiki_cache_path = args.cache_path
+    wiki_cache = entity_cache.open_entity_cache(args.cache_backend, wiki_cache_path)
 
     disable_cache_check = args.no_cache_check
-
-    if not args.append:
-        for f in os.listdir(data_path):
-            if f.startswith('Q') or f.endswith('.jpg') or f == f'entity_list.json':
-                os.remove(os.path.join(data_path, f))
-
+    site_output.compact_json = args.compact
+    use_derived_cache = not args.no_derived_cache
+
+    workers = max(1, args.workers)
+    compare_workers = max(1, args.compare_workers)
+    pool_size = max(workers, compare_workers if args.compare_site else 1)
+    if pool_size > 1:
+        http_transport.mount_pools(requests_session, pool_size)
+    http_transport.max_retries = max(0, args.max_retries)
+    http_transport.connect_timeout = args.connect_timeout
+    http_transport.read_timeout = args.read_timeout
+    for rate_limit in args.rate_limit:
+        http_transport.set_rate_limit(*http_transport.parse_rate_limit(rate_limit))
+
+    geo_shape_output = args.geo_shapes
+    ref_output = args.refs
+    incremental = args.incremental
+    checkpoint_interval = max(0, args.checkpoint_every)
     if args.disable_image_cache:
         use_image_cache = False
-
-    if args.site_file:
-        with open(args.site_file) as f:
-            site_json = json.load(f)
-        _logger.info(f'Processing {site_json["title"]} from {args.site_file}.')
-        bio_url_prefix = site_json.get('bioUrlPrefix')
-        property_override_url_prefix = site_json.get('propertyOverrideUrlPrefix')
-        publications_url_prefix = site_json.get('publicationsUrlPrefix')
-
-        if site_json.get('properties'):
-            load_properties_list(site_json.get('properties'))
-            _logger.info(f'allowed properties update with {allowed_properties}')
-
-        if site_json.get('idList'):
-            id_list = site_json['idList']
-            if isinstance(id_list, str):
-                id_list = load_id_list(id_list)
-            load_ids(id_list, bio_url_prefix, property_override_url_prefix, publications_url_prefix)
-        if site_json.get('sparql'):
-            load_sparql_results(site_json['sparql'], bio_url_prefix, property_override_url_prefix, publications_url_prefix)
-
-        shutil.copyfile(args.site_file, os.path.join(data_path, 'site.json'))
-    elif args.entity_id:
-        load(args.entity_id)
-    elif args.id_file:
-        pattern = re.compile("^Q([0-9]+)$")
-        with open(args.id_file, 'r') as file:
-            ids = [line.strip() for line in file.readlines() if pattern.match(line.strip())]
-        load_ids(ids)
+    image_renditions = args.image_renditions
+
+    if args.site_files:
+        plans = [site_plan(*site_file_entry(entry)) for entry in args.site_files]
+        prefetch_sites(plans)
+        for plan in plans:
+            with run_metrics.stage('site'):
+                build_site(args, plan)
     else:
-        with open(args.sparql_file, 'r') as file:
-            sparql = file.read()
-        load_sparql_results(sparql)
+        build_site(args, site_plan(args.site_file, data_path) if args.site_file else None)
 
-    extract_location_information()
-    with open(os.path.join(data_path, 'search_index.json'), 'w') as f:
-        json.dump(search_index, f)
-
-    if args.compare_site:
-        compare_with_site(args.compare_site)
+    if args.metrics:
+        run_metrics.write_summary(args.metrics)
+    if args.trace:
+        run_metrics.write_trace(args.trace)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()